@@ -12,8 +12,19 @@ from app.components.navbar import navbar
 # Import Langchain interface  and use base chain
 from app.utils.watsonxga import WatsonxLangchainLLM
 from app.utils.watsonxworkbench import WatsonxWorkbenchLangchainLLM
+from app.utils.watsonxmock import WatsonxMockLangchainLLM
 from app.utils.vectorstore import VectorStore
+from app.utils.embeddings import warm_embedding_models
+from app.utils.semanticcache import semantic_cache
+from app.utils.scheduler import BUSY_MESSAGE, SchedulerFull, schedulers
+from app.utils.streaming import latency_stats
+from app.utils.llmcache import response_cache
 from app.utils.prompts import ragprompt
+from app.utils.promptbuilder import PromptBuilder
+from app.utils.rollingsummary import RollingSummaries
+from app.utils.messagelog import fan_out
+from app.utils.sessionregistry import SessionRegistry
+from app.utils.sessionlifecycle import SessionLifecycle
 
 from ibm_watson_machine_learning.foundation_models.utils.enums import ModelTypes
 from ibm_watson_machine_learning.metanames import GenTextParamsMetaNames as GenParams
@@ -32,7 +43,7 @@ if config.watsonx_type == "ga":
             GenParams.DECODING_METHOD: "greedy",
             GenParams.MAX_NEW_TOKENS: 200,
         },
-    ).from_pretrained()
+    ).shared()
 
 if config.watsonx_type == "workbench":
     llm = WatsonxWorkbenchLangchainLLM(
@@ -42,16 +53,69 @@ if config.watsonx_type == "workbench":
             GenParams.MAX_NEW_TOKENS: 200,
             "stream": True,
         },
-    ).from_pretrained()
+    ).shared()
 
-store = VectorStore("assets/ibmfaqs.pdf")
+if config.watsonx_type == "mock":
+    # Offline stand-in for load and latency testing, see rxconfig for its settings
+    llm = WatsonxMockLangchainLLM(
+        model_id="meta-llama/llama-2-13b-chat",
+        generate_params={
+            GenParams.DECODING_METHOD: "greedy",
+            GenParams.MAX_NEW_TOKENS: 200,
+        },
+    ).shared()
+
+prompt_builder = PromptBuilder.for_llm(llm)
+rolling_summaries = RollingSummaries(llm, prompt_builder)
 
+# Load the embedding model once for the whole process before any event needs it
+warm_embedding_models()
 
-# Keep track of tokens associated with the same client browser ("shared" sessions)
-shared_sessions_by_token: dict[str, set[str]] = {}
+store = VectorStore("assets/ibmfaqs.pdf", ingest_workers=config.embedding_workers)
+
+
+# Keep track of tokens associated with the same client browser ("shared" sessions), their
+# websocket connections and their conversation, in process or shared between workers
+registry = SessionRegistry.from_url(
+    config.session_registry_url, ttl=config.session_idle_ttl
+)
+
+# Forget conversations, and their sessions' state, once nobody has used them for a while
+lifecycle = SessionLifecycle(
+    registry,
+    idle_ttl=config.session_idle_ttl,
+    sweep_interval=config.session_sweep_interval,
+)
 
-# Keep track of (shared_token, state_token) pairs for each websocket connection (sid)
-tokens_by_sid: dict[str, tuple[str, str]] = {}
+
+async def update_shared_sessions(client_token):
+    """Another worker changed the conversation, send it to this worker's sessions."""
+    lifecycle.touch(client_token)
+    log = await registry.log(client_token)
+    await fan_out(log, registry.local(client_token), app.modify_state)
+
+
+def forget_conversation(client_token, tokens):
+    registry.forget(client_token)
+    rolling_summaries.reset(client_token)
+
+    # The in-memory state manager never drops a session's state by itself
+    states = getattr(app.state_manager, "states", None)
+    if states is not None:
+        for token in tokens:
+            states.pop(token, None)
+
+
+registry.listen(update_shared_sessions)
+lifecycle.on_expire(forget_conversation)
+lifecycle.measure(rolling_summaries.retained_bytes)
+
+
+def format_message(message, side) -> list[str]:
+    """[text, alignment, colour] of a message on the client's or the bot's page."""
+    if message["role"] == side:
+        return [message["message"], "right", "#F5EFFE"]
+    return [message["message"], "left", "#DEEAFD"]
 
 
 class WhisperState(State):
@@ -61,137 +125,175 @@ class WhisperState(State):
     clientToken: str = rx.Cookie("")
     task_output: str = ""
 
-    # The messages is a special variable that is shared among all sessions with the same clientToken
-    messages: list[dict] = []
+    # The messages are shared among all sessions with the same clientToken, and kept on the
+    # backend, the pages render messages_for_client and messages_for_bot
+    _messages: list[dict] = []
+    messages_for_client: list[list[str]] = []
+    messages_for_bot: list[list[str]] = []
+    # How far through the shared message log this session is, backend only
+    _message_seq: int = 0
+    _message_epoch: int = 0
 
-    def ChangeBotMessage(self):
-        self.messages.append({"role": "bot", "message": self.botmessage})
+    async def ChangeBotMessage(self):
+        await self._append_message("bot", self.botmessage)
+        rolling_summaries.schedule(self.conversation_key, self._messages)
 
         # Apply changes to all other shared sessions
         return WhisperState.set_color_state_for_shared_sessions
 
-    def ChangeClientMessage(self):
-        self.messages.append({"role": "client", "message": self.clientmessage})
+    async def ChangeClientMessage(self):
+        await self._append_message("client", self.clientmessage)
+        rolling_summaries.schedule(self.conversation_key, self._messages)
 
         # Apply changes to all other shared sessions
         return WhisperState.set_color_state_for_shared_sessions
 
-    @rx.var
-    def format_messages_for_client(self) -> list[str]:
-        formatted_messages = []
-        for message in self.messages:
-            if message["role"] == "bot":
-                formatted_messages.append([message["message"], "left", "#DEEAFD"])
-            else:
-                formatted_messages.append([message["message"], "right", "#F5EFFE"])
-        return formatted_messages
-
-    @rx.var
-    def format_messages_for_bot(self) -> list[str]:
-        formatted_messages = []
-        for message in self.messages:
-            if message["role"] == "bot":
-                formatted_messages.append([message["message"], "right", "#F5EFFE"])
-            else:
-                formatted_messages.append([message["message"], "left", "#DEEAFD"])
-        return formatted_messages
+    def _add_messages(self, messages, replace=False):
+        """Add new messages, formatting only those, or replace the conversation."""
+        if replace:
+            self._messages = []
+            self.messages_for_client = []
+            self.messages_for_bot = []
+        self._messages.extend(messages)
+        self.messages_for_client.extend(
+            format_message(message, "client") for message in messages
+        )
+        self.messages_for_bot.extend(
+            format_message(message, "bot") for message in messages
+        )
+
+    async def _append_message(self, role, message):
+        lifecycle.touch(self.conversation_key, self.get_token())
+        log = await registry.append(self.conversation_key, role, message)
+        log.sync(self)
+
+    async def _reset_messages(self, messages=()):
+        lifecycle.touch(self.conversation_key, self.get_token())
+        log = await registry.reset(self.conversation_key, messages)
+        log.sync(self)
 
     async def set_color_state_for_shared_sessions(self):
-        """Iterate through all shared sessions and update them with the new messages."""
+        """Send the new messages to all other shared sessions at once."""
         if not self.clientToken:
-            self.set_client_token()
+            await self.set_client_token()
+
+        print(f"{self.clientToken} -> {registry.local(self.clientToken)}")
 
-        print(f"{self.clientToken} -> {shared_sessions_by_token[self.clientToken]}")
+        others = [
+            token
+            for token in registry.local(self.clientToken)
+            if token != self.get_token()
+        ]
+        await fan_out(await registry.log(self.clientToken), others, app.modify_state)
 
-        for token in shared_sessions_by_token.get(self.clientToken, set()):
-            if token != self.get_token():
-                async with app.modify_state(token) as other_state:
-                    other_state.substates["whisper_state"].messages = self.messages
+        # Sessions connected to other workers are updated by those workers
+        await registry.publish(self.clientToken)
 
     async def set_color_state_for_new_session(self):
-        """When a new session is created, copy the messages from another shared session."""
-        for token in shared_sessions_by_token.get(self.clientToken, set()):
-            if token != self.get_token():
-                async with app.modify_state(token) as other_state:
-                    self.messages = other_state.substates["whisper_state"].messages
-                    return
-
-    def set_client_token(self):
+        """When a new session is created, catch it up with the shared message log."""
+        log = await registry.log(self.clientToken)
+        log.sync(self)
+
+    async def set_client_token(self):
         """Page on_load handler uses the clientToken cookie to identify shared sessions."""
         if not self.clientToken:
             self.clientToken = self.get_token()
 
-        # Mark this state's token as belonging to the clientToken
-        shared_sessions_by_token.setdefault(self.clientToken, set()).add(
-            self.get_token()
-        )
-
-        # Mark this state's websocket id as belonging to the clientToken and state token
-        tokens_by_sid[self.get_sid()] = (self.clientToken, self.get_token())
+        # Mark this state's token and websocket id (sid) as belonging to the clientToken
+        await registry.join(self.clientToken, self.get_token(), self.get_sid())
+        lifecycle.touch(self.clientToken, self.get_token())
 
         # Set the messages for the new session from existing shared sessions (if any)
         return WhisperState.set_color_state_for_new_session
 
-    def interpret_last_question(self):
+    async def interpret_last_question(self):
         client_messages = []
-        for message in self.messages:
+        for message in self._messages:
             if message["role"] == "client":
                 client_messages.append(message["message"])
 
-        documents = store.query(client_messages[-1])
-        prompt = ragprompt(client_messages[-1], documents)
-        response = llm(prompt)
+        question = client_messages[-1]
+        cached = await semantic_cache.alookup(store, question)
+        response = cached.answer
+        if response is None:
+            documents = await store.aquery(question, cached.embedding)
+            prompt = ragprompt(question, documents)
+            try:
+                response = await llm.acall(prompt)
+            except SchedulerFull:
+                self.task_output = BUSY_MESSAGE
+                return
+            semantic_cache.put(cached, response)
 
         self.task_output = response
 
-    def interpret_conversation(self):
+    async def interpret_conversation(self):
         client_messages = []
-        for message in self.messages:
+        for message in self._messages:
             if message["role"] == "client":
                 client_messages.append(message["message"])
 
         all_messages = " ".join(client_messages)
 
-        documents = store.query(
+        documents = await store.aquery(
             f"Can you interpret this client conversation {all_messages}"
         )
-        prompt = ragprompt(
-            f"Can you interpret this client conversation {all_messages}", documents
+        # Keep the latest messages that fit alongside the retrieved documents
+        prompt = await prompt_builder.abuild(
+            lambda question, documents, history: ragprompt(
+                f"Can you interpret this client conversation {history}", documents
+            ),
+            documents=documents,
+            history=client_messages,
         )
-        response = llm(prompt)
+        try:
+            response = await llm.acall(prompt)
+        except SchedulerFull:
+            response = BUSY_MESSAGE
 
         self.task_output = response
 
-    def summarise_conversation(self):
-        client_messages = []
-        for message in self.messages:
-            client_messages.append(message["message"])
-
-        all_messages = " ".join(client_messages)
-
-        response = llm(f"Summarise this conversation {all_messages}")
+    async def summarise_conversation(self):
+        # Most of the conversation has already been summarised in the background
+        try:
+            response = await rolling_summaries.summarise(
+                self.conversation_key, self._messages
+            )
+        except SchedulerFull:
+            response = BUSY_MESSAGE
         self.task_output = response
 
-    def run_prompt(self):
-        self.messages = [
-            {
-                "role": "client",
-                "message": "Hey how's it going, I was hoping to get some help",
-            },
-            {"role": "bot", "message": "Sure what can I help you with?"},
-            {
-                "role": "client",
-                "message": "I was hoping you can help me with watsonx.ai?",
-            },
-            {"role": "bot", "message": "Not an issue, what's the question?"},
-            {"role": "client", "message": "Well, what is watsonx.ai?"},
-        ]
+    @property
+    def conversation_key(self):
+        """Shared sessions have one conversation, and so one running summary."""
+        return self.clientToken or self.get_token()
+
+    async def run_prompt(self):
+        rolling_summaries.reset(self.conversation_key)
+        await self._reset_messages(
+            [
+                {
+                    "role": "client",
+                    "message": "Hey how's it going, I was hoping to get some help",
+                },
+                {"role": "bot", "message": "Sure what can I help you with?"},
+                {
+                    "role": "client",
+                    "message": "I was hoping you can help me with watsonx.ai?",
+                },
+                {"role": "bot", "message": "Not an issue, what's the question?"},
+                {"role": "client", "message": "Well, what is watsonx.ai?"},
+            ]
+        )
+        return WhisperState.set_color_state_for_shared_sessions
 
-    def clear_state(self):
+    async def clear_state(self):
+        rolling_summaries.reset(self.conversation_key)
         self.botmessage = ""
         self.clientmessage = ""
         self.task_output = ""
-        self.messages = []
+        await self._reset_messages()
+        return WhisperState.set_color_state_for_shared_sessions
 
 
 @rx.page(
@@ -301,8 +403,6 @@ def page2() -> rx.Component:
     )
 
 
-# from app.client.whisper import shared_sessions_by_token, tokens_by_sid
-
 # Add state and page to the app.
 app = rx.App()
 app.compile()
@@ -311,16 +411,32 @@ app.compile()
 orig_disconnect = app.event_namespace.on_disconnect
 
 
-def disconnect_handler(sid):
+async def disconnect_handler(sid):
     orig_disconnect(sid)
 
-    clientToken, token = tokens_by_sid.get(sid, (None, None))
+    clientToken, token = await registry.leave(sid)
     print(
         f"Disconnect event received for {sid}. Removing {token} from shared {clientToken}"
     )
 
-    shared_sessions_by_token.get(clientToken, set()).discard(token)
-    tokens_by_sid.pop(sid, None)
+    # The conversation's idle time starts from its last session leaving
+    if clientToken is not None:
+        lifecycle.touch(clientToken)
 
 
 app.event_namespace.on_disconnect = disconnect_handler
+
+
+async def stats():
+    """Counters of the schedulers, caches, streams and sessions of this worker."""
+    return {
+        "schedulers": {backend: scheduler.stats for backend, scheduler in schedulers.items()},
+        "vectorstore": store.cache_stats,
+        "semantic_cache": semantic_cache.stats,
+        "response_cache": response_cache.stats,
+        "latency": {label: latency.summary() for label, latency in latency_stats.items()},
+        "sessions": lifecycle.stats(),
+    }
+
+
+app.api.add_api_route("/stats", stats)
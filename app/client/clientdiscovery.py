@@ -1,5 +1,6 @@
 import reflex as rx
 import os
+from functools import partial
 
 # Import app components
 from app.components.navbar import navbar
@@ -13,7 +14,12 @@ from app.config import style
 # Import Langchain interface  and use base chain
 from app.utils.watsonxga import WatsonxLangchainLLM
 from app.utils.watsonxworkbench import WatsonxWorkbenchLangchainLLM
-from app.utils.vectorstore import VectorStore
+from app.utils.watsonxmock import WatsonxMockLangchainLLM
+from app.utils.sessionstores import SessionStores
+from app.utils.semanticcache import semantic_cache
+from app.utils.streaming import athrottle
+from app.utils.taskgraph import TaskGraph
+from app.utils.scheduler import BUSY_MESSAGE, Priority, SchedulerFull
 from app.utils.prompts import ragprompt
 
 from ibm_watson_machine_learning.foundation_models.utils.enums import ModelTypes
@@ -23,6 +29,8 @@ os.environ["TOKENIZERS_PARALLELISM"] = "False"
 
 config = rx.config.get_config()
 
+# Prompts here quote uploaded client profiles, which mustn't outlive the session's upload, so
+# their completions aren't kept in the response cache
 if config.watsonx_type == "ga":
     # Create Starcoder chain
     llm = WatsonxLangchainLLM(
@@ -31,7 +39,8 @@ if config.watsonx_type == "ga":
             GenParams.DECODING_METHOD: "greedy",
             GenParams.MAX_NEW_TOKENS: 200,
         },
-    ).from_pretrained()
+        cache=False,
+    ).shared()
 
 if config.watsonx_type == "workbench":
     llm = WatsonxWorkbenchLangchainLLM(
@@ -41,9 +50,38 @@ if config.watsonx_type == "workbench":
             GenParams.MAX_NEW_TOKENS: 200,
             "stream": True,
         },
-    ).from_pretrained()
+        cache=False,
+    ).shared()
 
-store = None
+if config.watsonx_type == "mock":
+    # Offline stand-in for load and latency testing, see rxconfig for its settings
+    llm = WatsonxMockLangchainLLM(
+        model_id="meta-llama/llama-2-13b-chat",
+        generate_params={
+            GenParams.DECODING_METHOD: "greedy",
+            GenParams.MAX_NEW_TOKENS: 200,
+        },
+        cache=False,
+    ).shared()
+
+# Each session gets its own collection for the documents it uploads
+session_stores = SessionStores()
+
+# Insights generated for every upload, by the state field they are shown in
+INSIGHTS = {
+    "background": "Provide a background summary of the background of the person",
+    "ideas": "What are some potential business ideas that this person would be interested in?",
+}
+# Insights generated at the same time across all uploads in the process, further insights
+# wait for one to finish
+MAX_CONCURRENT_INSIGHTS = 4
+
+
+def stream_insight(question, documents):
+    """Answer a question about an uploaded document, yielding the answer as it streams."""
+    return athrottle(
+        llm.astream(ragprompt(question, documents), priority=Priority.BACKGROUND)
+    )
 
 
 class ClientDiscoveryState(State):
@@ -58,78 +96,89 @@ class ClientDiscoveryState(State):
     ideas: str
     is_uploading: bool = False
 
+    # The question and answer currently being streamed
+    streaming_question: str = ""
+    streaming_answer: str = ""
+
     async def answer(self):
+        store = session_stores.get(self.get_token())
         if store:
-            if config.watsonx_type == "ga":
-                documents = store.query(self.question)
-                prompt = ragprompt(self.question, documents)
-
-                answer = llm(prompt)
-                self.chat_history.append((self.question, answer))
-            if config.watsonx_type == "workbench":
-
-                documents = store.query(self.question)
-                prompt = ragprompt(self.question, documents)
-
-                answer = ""
-                self.chat_history.append((self.question, ""))
-                for response in llm.stream(prompt):
-                    answer += response
-                    self.chat_history[-1] = (self.question, answer)
+            cached = await semantic_cache.alookup(store, self.question)
+            if cached.answer is not None:
+                self.chat_history.append((self.question, cached.answer))
+                return
+
+            documents = await store.aquery(self.question, cached.embedding)
+            prompt = ragprompt(self.question, documents)
+
+            # Stream into separate vars so updates don't resend the whole chat history
+            self.streaming_question = self.question
+            self.streaming_answer = ""
+            try:
+                async for text in athrottle(llm.astream(prompt)):
+                    self.streaming_answer += text
+                    yield
+            except SchedulerFull:
+                self.chat_history.append((self.question, BUSY_MESSAGE))
+                return
+            finally:
+                # Don't leave a half streamed answer on the page if the request fails
+                answer = self.streaming_answer
+                self.streaming_question = ""
+                self.streaming_answer = ""
+
+            self.chat_history.append((self.question, answer))
+            semantic_cache.put(cached, answer)
 
         else:
             self.chat_history.append((self.question, "Document Not Loaded"))
 
     async def handle_upload(self, files: list[rx.UploadFile]):
-        global store
-
         for file in files:
             upload_data = await file.read()
-            outfile = "assets/profile.pdf"
-
-            # Save the file.
-            with open(outfile, "wb") as file_object:
-                file_object.write(upload_data)
 
-        store = VectorStore("assets/profile.pdf")
+        store = await session_stores.ingest(
+            self.get_token(), upload_data, ingest_workers=config.embedding_workers
+        )
         self.store_created = True
+        self.background = ""
+        self.ideas = ""
 
-        if config.watsonx_type == "ga":
-            question = "Provide a background summary of the background of the person"
-            documents = store.query(question)
-            prompt = ragprompt(question, documents)
-            self.background = llm(prompt)
-
-            question = "What are some potential business ideas that this person would be interested in?"
-            documents = store.query(question)
-            prompt = ragprompt(question, documents)
-            self.ideas = llm(prompt)
-
-        if config.watsonx_type == "workbench":
-            question = "Provide a background summary of the background of the person"
-            documents = store.query(question)
-            prompt = ragprompt(question, documents)
-
-            answer = ""
-            for response in llm.stream(prompt):
-                answer += response
-                self.background = answer
-
-            question = "What are some potential business ideas that this person would be interested in?"
-            documents = store.query(question)
-            prompt = ragprompt(question, documents)
-
-            answer = ""
-            for response in llm.stream(prompt):
-                answer += response
-                self.ideas = answer
+        # Show the insights as they stream in rather than the loading skeleton
+        self.is_uploading = False
+        yield
+
+        # Every insight's retrieval and generation run concurrently, updating whichever
+        # field has new text
+        graph = TaskGraph(limits={config.watsonx_type: MAX_CONCURRENT_INSIGHTS})
+        for field, question in INSIGHTS.items():
+            graph.add(f"{field}_documents", partial(store.aquery, question))
+            graph.add(
+                field,
+                partial(stream_insight, question),
+                after=[f"{field}_documents"],
+                backend=config.watsonx_type,
+            )
+
+        try:
+            async for field, text in graph.stream():
+                setattr(self, field, getattr(self, field) + text)
+                yield
+        except SchedulerFull:
+            for field in INSIGHTS:
+                if not getattr(self, field):
+                    setattr(self, field, BUSY_MESSAGE)
 
     def run_prompt(self, prompt):
         self.question = prompt
 
-    def clear_state(self):
+    async def clear_state(self):
+        await session_stores.discard(self.get_token())
+
         self.question = ""
         self.chat_history = []
+        self.streaming_question = ""
+        self.streaming_answer = ""
 
         self.store_created = False
         self.file_name = ""
@@ -212,7 +261,7 @@ def index() -> rx.Component:
                     top="0",
                 ),
                 rx.vstack(
-                    chat(ClientDiscoveryState),
+                    chat(ClientDiscoveryState, streaming=True),
                     action_bar(ClientDiscoveryState),
                     height="100vh",
                     display="flex",
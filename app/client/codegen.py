@@ -11,6 +11,10 @@ from app.config import style
 # Import Starcoder and use base chain
 from app.utils.watsonxga import WatsonxLangchainLLM
 from app.utils.watsonxworkbench import WatsonxWorkbenchLangchainLLM
+from app.utils.watsonxmock import WatsonxMockLangchainLLM
+from app.utils.streaming import athrottle
+from app.utils.promptbuilder import PromptBuilder
+from app.utils.scheduler import BUSY_MESSAGE, SchedulerFull
 from ibm_watson_machine_learning.foundation_models.utils.enums import ModelTypes
 from ibm_watson_machine_learning.metanames import GenTextParamsMetaNames as GenParams
 
@@ -26,7 +30,7 @@ if config.watsonx_type == "ga":
             GenParams.DECODING_METHOD: "greedy",
             GenParams.MAX_NEW_TOKENS: 200,
         },
-    ).from_pretrained()
+    ).shared()
 
 if config.watsonx_type == "workbench":
     llm = WatsonxWorkbenchLangchainLLM(
@@ -36,7 +40,19 @@ if config.watsonx_type == "workbench":
             GenParams.MAX_NEW_TOKENS: 200,
             "stream": True,
         },
-    ).from_pretrained()
+    ).shared()
+
+if config.watsonx_type == "mock":
+    # Offline stand-in for load and latency testing, see rxconfig for its settings
+    llm = WatsonxMockLangchainLLM(
+        model_id="codellama/codellama-34b-instruct",
+        generate_params={
+            GenParams.DECODING_METHOD: "greedy",
+            GenParams.MAX_NEW_TOKENS: 200,
+        },
+    ).shared()
+
+prompt_builder = PromptBuilder.for_llm(llm)
 
 
 class CodeGenState(State):
@@ -46,26 +62,51 @@ class CodeGenState(State):
     code_history: str
     chat_history: list[tuple[str, str]]
 
+    # The question and answer currently being streamed
+    streaming_question: str = ""
+    streaming_answer: str = ""
+
     async def answer(self):
         if config.watsonx_type == "ga":
-            answer = llm(self.question)
-            self.code_history += str(answer)
-            self.chat_history.append((self.question, answer))
-            self.question = ""
-
-        if config.watsonx_type == "workbench":
-            history = "\n ".join(
-                [f"Q:{chat[0]} H:{chat[1]}" for chat in self.chat_history]
+            prompt = self.question
+        else:
+            # Drop the oldest interactions once the history no longer fits the context
+            prompt = await prompt_builder.abuild(
+                lambda question, documents, history: starcoder_template(
+                    history, question
+                ),
+                question=self.question,
+                history=[f"Q:{chat[0]} H:{chat[1]}" for chat in self.chat_history],
+                separator="\n ",
             )
-            prompt = starcoder_template(history, self.question)
-            self.chat_history.append((self.question, ""))
-            answer = ""
-            for response in llm.stream(prompt):
-                answer += response
-                self.code_history += str(response)
-                self.chat_history[-1] = (self.question, answer)
+
+        # Stream into separate vars so each update only carries the answer so far, and
+        # coalesce tokens so there's one update per 50ms or 64 characters
+        self.streaming_question = self.question
+        self.streaming_answer = ""
+        updates = 0
+        bytes_sent = 0
+        try:
+            async for text in athrottle(llm.astream(prompt), interval=0.05, max_chars=64):
+                self.streaming_answer += text
+                updates += 1
+                bytes_sent += len(self.streaming_answer.encode())
                 yield
-            self.question = ""
+        except SchedulerFull:
+            self.chat_history.append((self.question, BUSY_MESSAGE))
+            return
+        finally:
+            # Don't leave a half streamed answer on the page if the request fails
+            answer = self.streaming_answer
+            self.streaming_question = ""
+            self.streaming_answer = ""
+
+        self.chat_history.append((self.question, answer))
+        self.code_history += answer
+        print(
+            f"Streamed {len(answer)} characters in {updates} updates ({bytes_sent} bytes)"
+        )
+        self.question = ""
 
     def run_prompt(self, prompt):
         self.question = prompt
@@ -74,6 +115,8 @@ class CodeGenState(State):
         self.question = ""
         self.code_history = ""
         self.chat_history = []
+        self.streaming_question = ""
+        self.streaming_answer = ""
 
 
 def starcoder_template(history, prompt):
@@ -82,9 +125,11 @@ def starcoder_template(history, prompt):
 
 def codeblock() -> rx.Component:
     return rx.cond(
-        CodeGenState.code_history,
+        CodeGenState.code_history | CodeGenState.streaming_answer,
         rx.code_block(
-            CodeGenState.code_history, language="python", show_line_numbers=True
+            CodeGenState.code_history + CodeGenState.streaming_answer,
+            language="python",
+            show_line_numbers=True,
         ),
     )
 
@@ -135,7 +180,7 @@ def index() -> rx.Component:
                     top="0",
                 ),
                 rx.vstack(
-                    chat(CodeGenState),
+                    chat(CodeGenState, streaming=True),
                     action_bar(CodeGenState),
                     height="100vh",
                     display="flex",
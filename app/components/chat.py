@@ -10,9 +10,20 @@ def qa(question: str, answer: str) -> rx.Component:
     )
 
 
-def chat(state) -> rx.Component:
+def chat(state, streaming=False) -> rx.Component:
+    """Render the chat history, plus the answer being streamed if streaming is set.
+
+    Streaming states keep the question and answer in progress in streaming_question and
+    streaming_answer, so updates don't resend the whole chat history.
+    """
     return rx.box(
         rx.foreach(state.chat_history, lambda messages: qa(messages[0], messages[1])),
+        rx.cond(
+            state.streaming_question,
+            qa(state.streaming_question, state.streaming_answer),
+        )
+        if streaming
+        else rx.fragment(),
         flex="1",  # This allows the chat box to take up all available space
     )
 
@@ -66,14 +77,14 @@ def qa_live(message: list) -> rx.Component:
 
 def chat_live_client(state) -> rx.Component:
     return rx.box(
-        rx.foreach(state.format_messages_for_client, lambda message: qa_live(message)),
+        rx.foreach(state.messages_for_client, lambda message: qa_live(message)),
         flex="1",  # This allows the chat box to take up all available space
     )
 
 
 def chat_live_bot(state) -> rx.Component:
     return rx.box(
-        rx.foreach(state.format_messages_for_bot, lambda message: qa_live(message)),
+        rx.foreach(state.messages_for_bot, lambda message: qa_live(message)),
         flex="1",  # This allows the chat box to take up all available space
     )
 
@@ -0,0 +1,88 @@
+import heapq
+import math
+import re
+from array import array
+from collections import Counter
+from operator import itemgetter
+
+# Keep dotted and hyphenated names like watsonx.ai or ERR-1042 together as one term
+TOKEN_PATTERN = re.compile(r"\w+(?:[.\-]\w+)*")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """In-memory Okapi BM25 keyword index over the chunks of a vector store.
+
+    Each term's postings are stored as two parallel arrays of document numbers and term
+    frequencies rather than lists of Python objects.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+        self.doc_ids: list[str] = []
+        self.doc_lengths = array("I")
+        self.total_length = 0
+
+        self._doc_numbers: dict[str, int] = {}
+        self._postings: dict[str, tuple[array, array]] = {}
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def add(self, doc_id, text):
+        """Index a document, ignoring ids that are already indexed."""
+        if doc_id in self._doc_numbers:
+            return
+
+        doc_number = len(self.doc_ids)
+        term_counts = Counter(tokenize(text))
+        for term, frequency in term_counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = (array("I"), array("I"))
+            postings[0].append(doc_number)
+            postings[1].append(frequency)
+
+        length = sum(term_counts.values())
+        self.doc_lengths.append(length)
+        self.total_length += length
+        self._doc_numbers[doc_id] = doc_number
+        self.doc_ids.append(doc_id)
+
+    def search(self, query, n_results) -> list[tuple[str, float]]:
+        """Return up to n_results (doc_id, score) pairs, best first."""
+        n_docs = len(self.doc_ids)
+        if not n_docs:
+            return []
+        average_length = self.total_length / n_docs
+
+        scores: dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            doc_numbers, frequencies = postings
+
+            n_matches = len(doc_numbers)
+            idf = math.log(1 + (n_docs - n_matches + 0.5) / (n_matches + 0.5))
+            for doc_number, frequency in zip(doc_numbers, frequencies):
+                length_norm = 1 - self.b + self.b * self.doc_lengths[doc_number] / average_length
+                score = idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+                scores[doc_number] = scores.get(doc_number, 0.0) + score
+
+        best = heapq.nlargest(n_results, scores.items(), key=itemgetter(1))
+        return [(self.doc_ids[doc_number], score) for doc_number, score in best]
+
+
+def reciprocal_rank_fusion(rankings, k=60) -> list[str]:
+    """Merge several best-first lists of ids into one, scoring each id by sum(1 / (k + rank))."""
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -0,0 +1,55 @@
+import atexit
+import threading
+from sentence_transformers import SentenceTransformer
+
+DEFAULT_EMBEDDING_MODEL = "thenlper/gte-small"
+
+# Process-wide registry of loaded embedding models, keyed by model name
+_models: dict[str, SentenceTransformer] = {}
+_models_lock = threading.Lock()
+
+# Multi-process encoding pools, keyed by (model name, number of processes)
+_pools: dict[tuple[str, int], dict] = {}
+_pools_lock = threading.Lock()
+
+
+def get_embedding_model(model_name: str = DEFAULT_EMBEDDING_MODEL) -> SentenceTransformer:
+    """Return the shared instance of model_name, loading it on first use."""
+    model = _models.get(model_name)
+    if model is not None:
+        return model
+
+    with _models_lock:
+        # Another event may have loaded the model while we waited for the lock
+        model = _models.get(model_name)
+        if model is None:
+            model = SentenceTransformer(model_name)
+            _models[model_name] = model
+    return model
+
+
+def warm_embedding_models(*model_names: str):
+    """Load embedding models up front so the first query doesn't pay for it."""
+    for model_name in model_names or (DEFAULT_EMBEDDING_MODEL,):
+        get_embedding_model(model_name)
+
+
+def get_embedding_pool(model_name: str, processes: int) -> dict:
+    """Return a shared pool of CPU worker processes that encode with model_name."""
+    key = (model_name, processes)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = get_embedding_model(model_name).start_multi_process_pool(
+                ["cpu"] * processes
+            )
+            _pools[key] = pool
+    return pool
+
+
+@atexit.register
+def stop_embedding_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            SentenceTransformer.stop_multi_process_pool(pool)
+        _pools.clear()
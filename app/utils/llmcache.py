@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from app.utils.lrucache import LRUCache
+
+
+def cache_key(model_id, params, prompt):
+    """Identify a completion by everything that determines its output."""
+    payload = json.dumps(
+        {"model_id": model_id, "params": params, "prompt": prompt},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def is_deterministic(params):
+    """Greedy decoding always gives the same completion for the same prompt."""
+    return params.get("decoding_method", "greedy") == "greedy"
+
+
+class ResponseCache:
+    """Two tier cache of completions: an in-memory LRU in front of a SQLite file.
+
+    Completions are stored as the list of chunks they were streamed in, so a cached
+    response can be replayed as a stream as well as returned whole.
+    """
+
+    # Completions can quote uploaded profiles, so the file is kept out of the served assets/
+    def __init__(self, path="data/llmcache.sqlite3", maxsize=512, ttl=7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize)
+        self.disk_hits = 0
+
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, chunks TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)
+            )
+            self._connection.commit()
+        return self._connection
+
+    def get(self, key) -> list[str] | None:
+        entry = self.memory.get(key)
+        if entry is not None:
+            chunks, created = entry
+            if time.time() - created < self.ttl:
+                return chunks
+            self.memory.pop(key)
+
+        with self._lock:
+            row = (
+                self.connection()
+                .execute(
+                    "SELECT chunks, created FROM responses WHERE key = ? AND created >= ?",
+                    (key, time.time() - self.ttl),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return None
+
+        chunks = json.loads(row[0])
+        self.memory.put(key, (chunks, row[1]))
+        self.disk_hits += 1
+        return chunks
+
+    def put(self, key, chunks: list[str]):
+        created = time.time()
+        self.memory.put(key, (chunks, created))
+        with self._lock:
+            connection = self.connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, chunks, created) VALUES (?, ?, ?)",
+                (key, json.dumps(chunks), created),
+            )
+            connection.commit()
+
+    @property
+    def stats(self) -> dict:
+        return {**self.memory.stats, "disk_hits": self.disk_hits}
+
+
+# Shared by every cached LLM in the process
+response_cache = ResponseCache()
+
+
+class CachedLLM:
+    """Wraps a langchain LLM so identical greedy completions are served from the cache.
+
+    Sampled completions aren't reproducible, so they always go to the model.
+    """
+
+    def __init__(self, llm, model_id, params, cache=response_cache):
+        self.llm = llm
+        self.model_id = model_id
+        self.params = params
+        self.cache = cache
+
+        self.cacheable = is_deterministic(params)
+
+    def lookup(self, prompt) -> list[str] | None:
+        """Return the cached chunks for prompt without calling the model on a miss."""
+        if not self.cacheable:
+            return None
+        return self.cache.get(cache_key(self.model_id, self.params, prompt))
+
+    def __call__(self, prompt) -> str:
+        if not self.cacheable:
+            return self.llm(prompt)
+
+        key = cache_key(self.model_id, self.params, prompt)
+        chunks = self.cache.get(key)
+        if chunks is None:
+            chunks = [self.llm(prompt)]
+            self.cache.put(key, chunks)
+        return "".join(chunks)
+
+    def stream(self, prompt):
+        chunks = self.lookup(prompt)
+        if chunks is not None:
+            yield from chunks
+            return
+        yield from self.stream_after_miss(prompt)
+
+    def stream_after_miss(self, prompt):
+        """Stream from the model and cache the completion, for callers that have already
+        looked the prompt up and missed."""
+        if not self.cacheable:
+            yield from self.llm.stream(prompt)
+            return
+
+        chunks = []
+        for chunk in self.llm.stream(prompt):
+            chunks.append(chunk)
+            yield chunk
+        # Only cache completions that were streamed to the end
+        self.cache.put(cache_key(self.model_id, self.params, prompt), chunks)
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import threading
+
+from app.utils.llmcache import CachedLLM, cache_key, is_deterministic
+from app.utils.scheduler import Priority, get_scheduler
+from app.utils.singleflight import SingleFlight
+from app.utils.streaming import astream
+
+# Process-wide LLM clients, keyed by backend, model id, generation params and caching
+_clients: dict[tuple[str, str, str, bool], object] = {}
+_clients_lock = threading.Lock()
+
+# Identical requests running at the same time share one upstream call
+in_flight = SingleFlight()
+
+
+def llm_key(spec):
+    params = json.dumps(spec.generate_params, sort_keys=True, default=str)
+    return (spec.backend, spec.model_id, params, spec.cache)
+
+
+def get_llm(spec):
+    """Return the shared client for a WatsonxLangchainLLM/WatsonxWorkbenchLangchainLLM,
+    creating it (and authenticating) on first use."""
+    key = llm_key(spec)
+    llm = _clients.get(key)
+    if llm is not None:
+        return llm
+
+    with _clients_lock:
+        llm = _clients.get(key)
+        if llm is None:
+            llm = spec.from_pretrained()
+            _clients[key] = llm
+    return llm
+
+
+class SharedLLM:
+    """Stands in for an LLM client at import time and resolves it from the registry on
+    first use, so pages asking for the same model and params share one client."""
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    @property
+    def llm(self):
+        return get_llm(self.spec)
+
+    def __call__(self, prompt):
+        return self.llm(prompt)
+
+    def stream(self, prompt):
+        return self.llm.stream(prompt)
+
+    async def astream(self, prompt, priority=Priority.INTERACTIVE):
+        """Async iterator over the completion's chunks, for either backend.
+
+        Requests that aren't answered from the response cache wait for the backend's
+        scheduler, and raise SchedulerFull if too many are already waiting. Identical
+        greedy requests made while one is running share its stream.
+        """
+        # Creating the client authenticates, and the cache may read SQLite, so both run
+        # off the event loop
+        llm = await asyncio.to_thread(get_llm, self.spec)
+        if isinstance(llm, CachedLLM):
+            chunks = await asyncio.to_thread(llm.lookup, prompt)
+            if chunks is not None:
+                for chunk in chunks:
+                    yield chunk
+                return
+
+        if not is_deterministic(self.spec.generate_params):
+            async for chunk in self.upstream(llm, prompt, priority):
+                yield chunk
+            return
+
+        key = cache_key(self.spec.model_id, self.spec.generate_params, prompt)
+        async for chunk in in_flight.stream(
+            key, lambda: self.upstream(llm, prompt, priority)
+        ):
+            yield chunk
+
+    async def upstream(self, llm, prompt, priority):
+        async with get_scheduler(self.spec.backend).slot(priority):
+            # The response cache was already checked in astream, so don't look it up again
+            stream = llm.stream_after_miss if isinstance(llm, CachedLLM) else None
+            async for chunk in astream(llm, prompt, label=self.spec.model_id, stream=stream):
+                yield chunk
+
+    async def acall(self, prompt, priority=Priority.INTERACTIVE) -> str:
+        """Like calling the LLM, but awaitable without blocking the event loop."""
+        return "".join([chunk async for chunk in self.astream(prompt, priority)])
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
@@ -0,0 +1,54 @@
+import asyncio
+import sys
+
+
+class MessageLog:
+    """Append-only log of the messages of a conversation shared by several sessions.
+
+    Each message carries its sequence number, and each session records how much of the
+    log it has (_message_seq) so it only ever receives the entries after that. Replacing
+    the conversation starts a new epoch, which sessions pick up in full.
+    """
+
+    def __init__(self):
+        self.entries: list[dict] = []
+        self.epoch = 0
+        # Approximate memory held by the entries, kept up to date as they're added
+        self.nbytes = 0
+
+    @property
+    def seq(self):
+        return len(self.entries)
+
+    def append(self, role, message) -> dict:
+        entry = {"role": role, "message": message, "seq": self.seq + 1}
+        self.entries.append(entry)
+        self.nbytes += sys.getsizeof(entry) + sys.getsizeof(message)
+        return entry
+
+    def reset(self, messages=(), epoch=None):
+        """Replace the conversation, e.g. when it's cleared."""
+        self.epoch = self.epoch + 1 if epoch is None else epoch
+        self.entries = []
+        self.nbytes = 0
+        for message in messages:
+            self.append(message["role"], message["message"])
+
+    def sync(self, session):
+        """Bring a session up to date, passing its _add_messages the entries it's missing."""
+        if session._message_epoch != self.epoch or session._message_seq > self.seq:
+            session._add_messages(self.entries, replace=True)
+        elif session._message_seq < self.seq:
+            session._add_messages(self.entries[session._message_seq :])
+        session._message_seq = self.seq
+        session._message_epoch = self.epoch
+
+
+async def fan_out(log: MessageLog, tokens, modify_state, substate="whisper_state"):
+    """Send the new entries of the log to every session in tokens, all at once."""
+
+    async def update(token):
+        async with modify_state(token) as state:
+            log.sync(state.substates[substate])
+
+    await asyncio.gather(*(update(token) for token in tokens))
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+
+from app.utils.lrucache import LRUCache
+
+# Public Hugging Face tokenizers matching the watsonx models, the Llama 2 repos are gated
+TOKENIZERS = {
+    "meta-llama/llama-2-70b-chat": "hf-internal-testing/llama-tokenizer",
+    "meta-llama/llama-2-13b-chat": "hf-internal-testing/llama-tokenizer",
+    "codellama/codellama-34b-instruct-hf": "codellama/CodeLlama-34b-Instruct-hf",
+    "codellama/codellama-34b-instruct": "codellama/CodeLlama-34b-Instruct-hf",
+}
+
+# Rough characters per token, used when no tokenizer is available for the model
+CHARS_PER_TOKEN = 4
+
+
+class TokenCounter:
+    """Counts and truncates text in a model's tokens, caching the count of each text seen."""
+
+    def __init__(self, model_id, cache_size=4096):
+        self.model_id = model_id
+        self.counts = LRUCache(cache_size)
+
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def tokenizer(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    try:
+                        from transformers import AutoTokenizer
+
+                        self._tokenizer = AutoTokenizer.from_pretrained(
+                            TOKENIZERS.get(self.model_id, self.model_id)
+                        )
+                    except Exception as e:
+                        print(f"No tokenizer for {self.model_id}, estimating tokens: {e}")
+                    self._loaded = True
+        return self._tokenizer
+
+    def count(self, text) -> int:
+        count = self.counts.get(text)
+        if count is None:
+            if self.tokenizer is None:
+                count = -(-len(text) // CHARS_PER_TOKEN)
+            else:
+                count = len(self.tokenizer.encode(text, add_special_tokens=False))
+            self.counts.put(text, count)
+        return count
+
+    def truncate(self, text, max_tokens, keep_end=False) -> str:
+        """Cut text down to max_tokens, keeping its start (or its end if keep_end)."""
+        if max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+
+        if self.tokenizer is None:
+            max_chars = max_tokens * CHARS_PER_TOKEN
+            return text[-max_chars:] if keep_end else text[:max_chars]
+
+        ids = self.tokenizer.encode(text, add_special_tokens=False)
+        ids = ids[-max_tokens:] if keep_end else ids[:max_tokens]
+        return self.tokenizer.decode(ids)
+
+
+class PromptBuilder:
+    """Fits prompts into a model's context window.
+
+    The template's own text is always kept. The question then gets up to question_share of
+    what's left, the retrieved documents up to documents_share of the rest, and the
+    history whatever remains, dropping its oldest messages first.
+    """
+
+    def __init__(
+        self,
+        model_id,
+        context_window=4096,
+        max_new_tokens=200,
+        question_share=0.25,
+        documents_share=0.5,
+    ):
+        self.counter = TokenCounter(model_id)
+        self.budget = context_window - max_new_tokens
+        self.question_share = question_share
+        self.documents_share = documents_share
+
+    @classmethod
+    def for_llm(cls, llm, **kwargs):
+        """Builder for a SharedLLM, reserving room for its max_new_tokens."""
+        return cls(
+            llm.spec.model_id,
+            max_new_tokens=llm.spec.generate_params.get("max_new_tokens", 200),
+            **kwargs,
+        )
+
+    def fit_history(self, messages, max_tokens, separator=" ") -> list[str]:
+        """The most recent messages whose tokens fit in max_tokens, oldest first."""
+        separator_tokens = self.counter.count(separator)
+        kept = []
+        for message in reversed(messages):
+            tokens = self.counter.count(message) + separator_tokens
+            if tokens > max_tokens:
+                if not kept:
+                    # Keep the end of the latest message rather than nothing at all
+                    kept.append(
+                        self.counter.truncate(
+                            message, max_tokens - separator_tokens, keep_end=True
+                        )
+                    )
+                break
+            max_tokens -= tokens
+            kept.append(message)
+        kept.reverse()
+        return kept
+
+    def build(self, template, question="", documents="", history=(), separator=" ") -> str:
+        """Render template(question, documents, history) within the token budget."""
+        remaining = self.budget - self.counter.count(template("", "", ""))
+
+        question = self.counter.truncate(question, int(remaining * self.question_share))
+        remaining -= self.counter.count(question)
+
+        documents = self.counter.truncate(documents, int(remaining * self.documents_share))
+        remaining -= self.counter.count(documents)
+
+        history = separator.join(self.fit_history(history, remaining, separator))
+        return template(question, documents, history)
+
+    async def abuild(self, *args, **kwargs) -> str:
+        """Like build, but tokenizes off the event loop."""
+        return await asyncio.to_thread(self.build, *args, **kwargs)
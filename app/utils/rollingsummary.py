@@ -0,0 +1,96 @@
+import asyncio
+import sys
+
+from app.utils.scheduler import Priority
+
+
+def summary_template(question, documents, history):
+    if not documents:
+        return f"Summarise this conversation {history}"
+    return (
+        f"Here is a summary of a conversation so far: {documents} "
+        f"Update the summary with these new messages and return only the updated summary: {history}"
+    )
+
+
+class RollingSummary:
+    """Summary of the first `folded` messages of a conversation."""
+
+    def __init__(self):
+        self.summary = ""
+        self.folded = 0
+        self.task: asyncio.Task | None = None
+
+
+class RollingSummaries:
+    """Keeps a running summary per conversation, folding in new messages in the background.
+
+    Once batch_size messages are waiting a background fold sends the model only the
+    current summary and those messages, so summarising on demand only has to fold in
+    whatever arrived since the last fold.
+    """
+
+    def __init__(self, llm, prompt_builder, batch_size=4):
+        self.llm = llm
+        self.prompt_builder = prompt_builder
+        self.batch_size = batch_size
+
+        self.conversations: dict[str, RollingSummary] = {}
+
+    def reset(self, key):
+        conversation = self.conversations.pop(key, None)
+        if conversation is not None and conversation.task is not None:
+            conversation.task.cancel()
+
+    def schedule(self, key, messages: list[dict]):
+        """Fold messages into the summary in the background if enough have arrived."""
+        conversation = self.get(key, messages)
+        if conversation.task is None and len(messages) - conversation.folded >= self.batch_size:
+            conversation.task = asyncio.create_task(
+                self.fold_in_background(conversation, list(messages))
+            )
+
+    async def summarise(self, key, messages: list[dict]) -> str:
+        """Summary of all messages, folding in any the background hasn't got to yet."""
+        conversation = self.get(key, messages)
+        if conversation.task is not None:
+            # A failed background fold just leaves more for this one to do
+            await asyncio.wait({conversation.task})
+        if conversation.folded < len(messages):
+            await self.fold(conversation, list(messages), Priority.INTERACTIVE)
+        return conversation.summary
+
+    def retained_bytes(self) -> int:
+        return sum(
+            sys.getsizeof(conversation.summary)
+            for conversation in self.conversations.values()
+        )
+
+    def get(self, key, messages) -> RollingSummary:
+        conversation = self.conversations.get(key)
+        # The conversation was cleared or replaced, so the summary no longer applies
+        if conversation is not None and conversation.folded > len(messages):
+            self.reset(key)
+            conversation = None
+        if conversation is None:
+            conversation = self.conversations[key] = RollingSummary()
+        return conversation
+
+    async def fold_in_background(self, conversation: RollingSummary, messages):
+        try:
+            await self.fold(conversation, messages, Priority.BACKGROUND)
+        except Exception as e:
+            print(f"Background summary of {len(messages)} messages failed: {e}")
+        finally:
+            conversation.task = None
+
+    async def fold(self, conversation: RollingSummary, messages, priority):
+        new_messages = [
+            f"{message['role']}: {message['message']}"
+            for message in messages[conversation.folded :]
+        ]
+        prompt = await self.prompt_builder.abuild(
+            summary_template, documents=conversation.summary, history=new_messages
+        )
+        conversation.summary = await self.llm.acall(prompt, priority)
+        conversation.folded = len(messages)
@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import itertools
+import statistics
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+
+import reflex as rx
+
+# Get reflex config
+config = rx.config.get_config()
+
+
+class Priority(IntEnum):
+    """Lower values are scheduled first."""
+
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+# Shown to users whose request was turned away by a full queue
+BUSY_MESSAGE = "watsonx is busy right now, please try again in a moment."
+
+
+class SchedulerFull(Exception):
+    """Raised instead of queueing when a backend already has max_queue requests waiting,
+    or by a waiting request that was displaced by a higher priority one."""
+
+
+class BackendScheduler:
+    """Admits requests to one LLM backend in priority order.
+
+    Requests wait until the backend has fewer than max_in_flight requests running and the
+    token bucket (refilled at rate per second, holding at most burst tokens) has a token.
+    When the queue is full, a request displaces the newest waiting request of a lower
+    priority, so background work can't lock interactive requests out.
+    """
+
+    def __init__(self, rate=2.0, burst=4, max_in_flight=8, max_queue=64):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+
+        self.in_flight = 0
+        self.rejected = 0
+        self.waits = deque(maxlen=200)
+
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._timer = None
+
+    @asynccontextmanager
+    async def slot(self, priority=Priority.INTERACTIVE):
+        """Hold one of the backend's in-flight slots for the duration of the block."""
+        if len(self._waiters) >= self.max_queue:
+            self._purge()
+        if len(self._waiters) >= self.max_queue and not self._displace(priority):
+            self.rejected += 1
+            raise SchedulerFull(f"{len(self._waiters)} requests are already waiting")
+
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), waiter))
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as we were cancelled
+                self._release()
+            else:
+                self._waiters = [entry for entry in self._waiters if entry[2] is not waiter]
+                heapq.heapify(self._waiters)
+            raise
+        self.waits.append(time.monotonic() - start)
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _purge(self):
+        """Drop waiters that were cancelled but haven't yet removed themselves."""
+        waiters = [entry for entry in self._waiters if not entry[2].done()]
+        if len(waiters) != len(self._waiters):
+            self._waiters = waiters
+            heapq.heapify(self._waiters)
+
+    def _displace(self, priority) -> bool:
+        """Turn away the newest waiter of a lower priority than priority, if there is one."""
+        if not self._waiters:
+            return False
+        newest = max(self._waiters)
+        if newest[0] <= priority:
+            return False
+
+        self._waiters.remove(newest)
+        heapq.heapify(self._waiters)
+        self.rejected += 1
+        newest[2].set_exception(SchedulerFull("Displaced by a higher priority request"))
+        return True
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _dispatch(self):
+        self._refill()
+        while self._waiters and self.in_flight < self.max_in_flight and self._tokens >= 1:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():
+                continue
+            self._tokens -= 1
+            self.in_flight += 1
+            waiter.set_result(None)
+
+        # Come back when the next token is due if requests are only waiting on the rate
+        if self._waiters and self.in_flight < self.max_in_flight and self._timer is None:
+            delay = (1 - self._tokens) / self.rate
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    @property
+    def stats(self) -> dict:
+        queued = [entry[0] for entry in self._waiters]
+        return {
+            "queue_depth": len(queued),
+            "queue_depth_by_priority": {
+                priority.name.lower(): queued.count(priority) for priority in Priority
+            },
+            "in_flight": self.in_flight,
+            "rejected": self.rejected,
+            "wait_p50": statistics.median(self.waits) if self.waits else 0.0,
+            "wait_max": max(self.waits, default=0.0),
+        }
+
+
+# One scheduler per backend (ga/workbench), shared by every client of that backend
+schedulers: dict[str, BackendScheduler] = {}
+
+
+def get_scheduler(backend) -> BackendScheduler:
+    scheduler = schedulers.get(backend)
+    if scheduler is None:
+        scheduler = schedulers[backend] = BackendScheduler(
+            rate=config.llm_requests_per_second,
+            burst=config.llm_burst,
+            max_in_flight=config.llm_max_in_flight,
+            max_queue=config.llm_max_queue,
+        )
+    return scheduler
@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+from typing import Any, NamedTuple
+
+import numpy as np
+import reflex as rx
+
+from app.utils.vectorstore import VectorStore, run_in_vectorstore_executor
+
+# Get reflex config
+config = rx.config.get_config()
+
+
+class SemanticLookup(NamedTuple):
+    # The cached answer, or None on a miss
+    answer: str | None
+    # Collection name and version the question was asked against
+    scope: tuple[str, int]
+    # Embedding of the question, reused for retrieval and for storing the answer
+    embedding: Any
+
+
+class SemanticCache:
+    """Answers to earlier RAG questions, returned for new questions that embed close enough.
+
+    Entries are scoped to the collection (and its version) they were answered from, and the
+    least recently used entries are evicted once maxsize is reached.
+    """
+
+    def __init__(self, threshold=0.95, maxsize=256):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        # (scope, entry number) -> (unit length question embedding, answer)
+        self._entries: OrderedDict[tuple, tuple[np.ndarray, str]] = OrderedDict()
+        self._next_entry = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, store: VectorStore, question) -> SemanticLookup:
+        scope = (store.collection.name, store.version)
+        # Repeated questions reuse the embedding the store already cached for them
+        embedding = store.embed_query(question)
+        unit = embedding / np.linalg.norm(embedding)
+
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == scope]
+            if keys:
+                similarities = np.stack([self._entries[key][0] for key in keys]) @ unit
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.hits += 1
+                    return SemanticLookup(self._entries[keys[best]][1], scope, embedding)
+            self.misses += 1
+
+        return SemanticLookup(None, scope, embedding)
+
+    async def alookup(self, store: VectorStore, question) -> SemanticLookup:
+        """Like lookup, but awaitable without blocking the event loop."""
+        return await run_in_vectorstore_executor(self.lookup, store, question)
+
+    def put(self, lookup: SemanticLookup, answer):
+        """Remember the answer to a question that missed the cache."""
+        unit = lookup.embedding / np.linalg.norm(lookup.embedding)
+        with self._lock:
+            self._entries[(lookup.scope, self._next_entry)] = (unit, answer)
+            self._next_entry += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, collection_name):
+        """Forget the answers from a collection, e.g. when its documents are deleted."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0][0] == collection_name]:
+                del self._entries[key]
+
+    @property
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
+
+
+# Shared by every page, entries are kept apart by their collection
+semantic_cache = SemanticCache(threshold=config.semantic_cache_threshold)
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+
+class SessionLifecycle:
+    """Forgets conversations once they've had no connected sessions for idle_ttl seconds.
+
+    Every sweep_interval seconds a background sweep walks the conversations in batches,
+    yielding to the event loop between them, and calls each on_expire callback with the
+    expired clientToken and the state tokens that were seen in it.
+    """
+
+    def __init__(self, registry, idle_ttl=3600, sweep_interval=60, batch_size=256):
+        self.registry = registry
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.batch_size = batch_size
+
+        self.last_seen: dict[str, float] = {}
+        self.tokens: dict[str, set[str]] = {}
+        self.expired = 0
+        self.callbacks = []
+        self.measures = []
+        self.task: asyncio.Task | None = None
+
+    def touch(self, client_token, token=None):
+        """Mark the conversation as active now, starting the sweeps if they aren't running."""
+        self.last_seen[client_token] = time.monotonic()
+        if token is not None:
+            self.tokens.setdefault(client_token, set()).add(token)
+
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def on_expire(self, callback):
+        """Call callback(client_token, tokens) when a conversation expires."""
+        self.callbacks.append(callback)
+
+    def measure(self, retained_bytes):
+        """Add retained_bytes() to the retained bytes in stats."""
+        self.measures.append(retained_bytes)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                # Conversations with sessions still connected mustn't expire from Redis
+                await self.registry.refresh()
+                expired = await self.sweep()
+                if expired:
+                    print(f"Expired {expired} idle conversations: {self.stats()}")
+            except Exception as e:
+                print(f"Session sweep failed: {e}")
+
+    async def sweep(self) -> int:
+        cutoff = time.monotonic() - self.idle_ttl
+        candidates = [key for key, seen in self.last_seen.items() if seen < cutoff]
+
+        expired = 0
+        for start in range(0, len(candidates), self.batch_size):
+            for client_token in candidates[start : start + self.batch_size]:
+                # Touched again since the sweep started, or still has sessions connected
+                if self.last_seen.get(client_token, cutoff) >= cutoff:
+                    continue
+                if self.registry.local(client_token):
+                    continue
+                self.expire(client_token)
+                expired += 1
+            await asyncio.sleep(0)
+        return expired
+
+    def expire(self, client_token):
+        del self.last_seen[client_token]
+        tokens = self.tokens.pop(client_token, set())
+        for callback in self.callbacks:
+            try:
+                callback(client_token, tokens)
+            except Exception as e:
+                print(f"Expiring {client_token} failed: {e}")
+        self.expired += 1
+
+    def stats(self) -> dict:
+        return {
+            "live_sessions": sum(len(tokens) for tokens in self.registry.local_tokens.values()),
+            "conversations": len(self.last_seen),
+            "retained_bytes": self.registry.retained_bytes()
+            + sum(retained_bytes() for retained_bytes in self.measures),
+            "expired": self.expired,
+        }
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import random
+import uuid
+
+from app.utils.messagelog import MessageLog
+
+
+class SessionRegistry:
+    """Which sessions share each clientToken's conversation, and that conversation's log.
+
+    This one keeps everything in the process, which is all a single backend worker needs.
+    Websocket updates can only be sent from the worker a session is connected to, so each
+    worker also keeps its own sessions in local_tokens.
+    """
+
+    def __init__(self):
+        # Sessions connected to this worker, by clientToken and by websocket id (sid)
+        self.local_tokens: dict[str, set[str]] = {}
+        self.sids: dict[str, tuple[str, str]] = {}
+
+        self.logs: dict[str, MessageLog] = {}
+        self.handler = None
+
+    @classmethod
+    def from_url(cls, url="", ttl=None):
+        if not url:
+            return cls()
+        return RedisSessionRegistry.from_url(url, ttl)
+
+    def local(self, client_token) -> set[str]:
+        return self.local_tokens.get(client_token, set())
+
+    async def join(self, client_token, token, sid):
+        self.local_tokens.setdefault(client_token, set()).add(token)
+        self.sids[sid] = (client_token, token)
+
+    async def leave(self, sid) -> tuple[str, str]:
+        """Forget a disconnected websocket, returning its (clientToken, token)."""
+        client_token, token = self.sids.pop(sid, (None, None))
+        tokens = self.local_tokens.get(client_token)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.local_tokens[client_token]
+        return client_token, token
+
+    def forget(self, client_token):
+        """Drop an idle conversation with no sessions connected to this worker."""
+        self.local_tokens.pop(client_token, None)
+        self.logs.pop(client_token, None)
+
+    def retained_bytes(self) -> int:
+        return sum(log.nbytes for log in self.logs.values())
+
+    async def log(self, client_token) -> MessageLog:
+        """The conversation's log, up to date."""
+        return self.logs.setdefault(client_token, MessageLog())
+
+    async def append(self, client_token, role, message) -> MessageLog:
+        log = await self.log(client_token)
+        log.append(role, message)
+        return log
+
+    async def reset(self, client_token, messages=()) -> MessageLog:
+        log = await self.log(client_token)
+        log.reset(messages)
+        return log
+
+    async def refresh(self):
+        """Keep the conversations of this worker's sessions alive, nothing expires in process."""
+
+    def listen(self, handler):
+        """Call handler(client_token) when another worker changes a local conversation."""
+        self.handler = handler
+
+    async def publish(self, client_token):
+        """Tell the other workers the conversation changed, there are none in process."""
+
+
+class RedisSessionRegistry(SessionRegistry):
+    """Shares sessions and conversations between workers through Redis.
+
+    Membership is a set per clientToken and each log a list of JSON messages with a random
+    epoch, so workers only fetch the entries they haven't seen. Changes are announced on a
+    pub/sub channel for the other workers to fan out to their own sessions. The keys expire
+    ttl seconds after the conversation was last used or refreshed, and a conversation
+    recreated after expiring gets a new epoch, so every worker reads it again from the start.
+    """
+
+    def __init__(self, redis, prefix="whisper", ttl=None):
+        super().__init__()
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.channel = self.key("updates")
+        self.worker_id = uuid.uuid4().hex
+        self.listener: asyncio.Task | None = None
+        # Reads of one conversation are serialised so they can't add the same entries twice
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    @classmethod
+    def from_url(cls, url, ttl=None):
+        if url.startswith("fakeredis://"):
+            # Embedded stand-in, registries in the same process share one fake server
+            from fakeredis import aioredis
+
+            redis = aioredis.FakeRedis(server=fake_server(), decode_responses=True)
+        else:
+            from redis import asyncio as aioredis
+
+            redis = aioredis.from_url(url, decode_responses=True)
+        return cls(redis, ttl=ttl)
+
+    def key(self, *parts):
+        return ":".join((self.prefix, *parts))
+
+    def expire(self, pipe, client_token):
+        if self.ttl:
+            for name in ("sessions", "log", "epoch"):
+                pipe.expire(self.key(name, client_token), self.ttl)
+
+    async def refresh(self):
+        if not self.ttl or not self.local_tokens:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for client_token in list(self.local_tokens):
+                self.expire(pipe, client_token)
+            await pipe.execute()
+
+    async def join(self, client_token, token, sid):
+        await super().join(client_token, token, sid)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.sadd(self.key("sessions", client_token), token)
+            self.expire(pipe, client_token)
+            await pipe.execute()
+
+        # Start listening once there's a running event loop and sessions to update
+        if self.handler is not None and self.listener is None:
+            self.listener = asyncio.create_task(self.receive())
+
+    async def leave(self, sid):
+        client_token, token = await super().leave(sid)
+        if token is not None:
+            await self.redis.srem(self.key("sessions", client_token), token)
+        return client_token, token
+
+    def forget(self, client_token):
+        super().forget(client_token)
+        self.locks.pop(client_token, None)
+
+    async def log(self, client_token):
+        log = self.logs.setdefault(client_token, MessageLog())
+        async with self.locks.setdefault(client_token, asyncio.Lock()):
+            while True:
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    pipe.get(self.key("epoch", client_token))
+                    pipe.llen(self.key("log", client_token))
+                    pipe.lrange(self.key("log", client_token), log.seq, -1)
+                    epoch, length, entries = await pipe.execute()
+
+                epoch = int(epoch or 0)
+                if epoch == log.epoch and length >= log.seq:
+                    for entry in entries:
+                        entry = json.loads(entry)
+                        log.append(entry["role"], entry["message"])
+                    return log
+
+                # Another worker replaced the conversation, or it expired and was started
+                # again, so read it from the start
+                log.reset(epoch=epoch)
+
+    async def append(self, client_token, role, message):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            # Only sets an epoch if the conversation is new or expired
+            pipe.set(self.key("epoch", client_token), new_epoch(), nx=True)
+            pipe.rpush(
+                self.key("log", client_token), json.dumps({"role": role, "message": message})
+            )
+            self.expire(pipe, client_token)
+            await pipe.execute()
+        return await self.log(client_token)
+
+    async def reset(self, client_token, messages=()):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(self.key("epoch", client_token), new_epoch())
+            pipe.delete(self.key("log", client_token))
+            if messages:
+                pipe.rpush(
+                    self.key("log", client_token),
+                    *(
+                        json.dumps({"role": message["role"], "message": message["message"]})
+                        for message in messages
+                    ),
+                )
+            self.expire(pipe, client_token)
+            await pipe.execute()
+        return await self.log(client_token)
+
+    async def publish(self, client_token):
+        await self.redis.publish(
+            self.channel, json.dumps({"worker": self.worker_id, "client_token": client_token})
+        )
+
+    async def notify(self, client_token):
+        try:
+            await self.handler(client_token)
+        except Exception as e:
+            print(f"Updating sessions of {client_token} failed: {e}")
+
+    async def receive(self):
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        update = json.loads(message["data"])
+                        # Only conversations with sessions on this worker need updating
+                        if update["worker"] != self.worker_id and self.local(
+                            update["client_token"]
+                        ):
+                            await self.notify(update["client_token"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Session registry updates interrupted, resubscribing: {e}")
+                await asyncio.sleep(1)
+
+
+def new_epoch() -> int:
+    # Random rather than counted, since the counter would expire with the conversation
+    return random.getrandbits(52)
+
+
+_fake_server = None
+
+
+def fake_server():
+    global _fake_server
+    if _fake_server is None:
+        import fakeredis
+
+        _fake_server = fakeredis.FakeServer()
+    return _fake_server
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+import chromadb
+
+from app.utils.embeddings import get_embedding_model
+from app.utils.semanticcache import semantic_cache
+from app.utils.vectorstore import VectorStore, run_in_vectorstore_executor
+
+
+class SessionStore(NamedTuple):
+    store: VectorStore
+    file_path: str
+    # Estimated size of the embeddings and documents held by the collection
+    memory_bytes: int
+    # Estimated size of the uploaded file plus the persisted collection
+    disk_bytes: int
+
+
+class SessionStores:
+    """Vector stores for uploaded documents, one per session, evicted least recently used first."""
+
+    # Uploads are private to their session, so they're kept out of the publicly served assets/
+    def __init__(
+        self,
+        upload_dir="data/uploads/",
+        persist_store="data/sessionvectorstore/",
+        max_sessions=32,
+        max_memory_bytes=256 * 1024 * 1024,
+        max_disk_bytes=1024 * 1024 * 1024,
+    ):
+        self.upload_dir = upload_dir
+        self.persist_store = persist_store
+        self.max_sessions = max_sessions
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        self._stores: OrderedDict[str, SessionStore] = OrderedDict()
+        # Uploads and collections from before this process started aren't counted in the
+        # quotas, so they're removed before the first ingest
+        self._started = time.time()
+        self._removed_orphans = False
+
+    def get(self, token) -> VectorStore | None:
+        """Return the store for the session token, marking it as recently used."""
+        entry = self._stores.get(token)
+        if entry is None:
+            return None
+        self._stores.move_to_end(token)
+        return entry.store
+
+    async def ingest(self, token, upload_data: bytes, **kwargs) -> VectorStore:
+        """Save an upload for the session and build its own collection from it."""
+        # Tokens are client supplied, so derive file and collection names from a hash
+        key = hashlib.sha256(token.encode()).hexdigest()[:12]
+        if not self._removed_orphans:
+            self._removed_orphans = True
+            await run_in_vectorstore_executor(self.remove_orphans)
+
+        file_path = os.path.join(self.upload_dir, f"{key}.pdf")
+        # Saved alongside the session's current upload until it has been ingested
+        pending_path = os.path.join(self.upload_dir, f"{key}.pending.pdf")
+        await run_in_vectorstore_executor(self.save_upload, pending_path, upload_data)
+
+        previous = self._stores.get(token)
+        previous_name = previous.store.collection.name if previous else None
+
+        # Building the collection also drops this session's previous upload, if any
+        try:
+            store = await VectorStore.aingest(
+                pending_path,
+                persist_store=self.persist_store,
+                collection_name=f"profile-{key}",
+                **kwargs,
+            )
+        except Exception:
+            # The session keeps its previous store and upload, if it had them
+            await run_in_vectorstore_executor(self.remove_file, pending_path)
+            raise
+        await run_in_vectorstore_executor(os.replace, pending_path, file_path)
+        if previous_name is not None and previous_name != store.collection.name:
+            semantic_cache.discard(previous_name)
+        self._stores[token] = await run_in_vectorstore_executor(
+            self.measure, store, file_path
+        )
+        self._stores.move_to_end(token)
+
+        for entry in self.evict():
+            await run_in_vectorstore_executor(self.remove, entry)
+        return store
+
+    async def discard(self, token):
+        """Forget the session's store and delete its collection and upload."""
+        entry = self._stores.pop(token, None)
+        if entry is not None:
+            await run_in_vectorstore_executor(self.remove, entry)
+
+    def evict(self) -> list[SessionStore]:
+        """Drop least recently used stores until the quotas are respected."""
+        evicted = []
+        while len(self._stores) > 1 and (
+            len(self._stores) > self.max_sessions
+            or self.memory_bytes > self.max_memory_bytes
+            or self.disk_bytes > self.max_disk_bytes
+        ):
+            token, entry = self._stores.popitem(last=False)
+            print(f"Evicting document store for session {token}")
+            evicted.append(entry)
+        return evicted
+
+    @property
+    def memory_bytes(self):
+        return sum(entry.memory_bytes for entry in self._stores.values())
+
+    @property
+    def disk_bytes(self):
+        return sum(entry.disk_bytes for entry in self._stores.values())
+
+    def __len__(self):
+        return len(self._stores)
+
+    def save_upload(self, file_path, upload_data):
+        os.makedirs(self.upload_dir, exist_ok=True)
+        with open(file_path, "wb") as file_object:
+            file_object.write(upload_data)
+
+    def measure(self, store, file_path) -> SessionStore:
+        model = get_embedding_model(store.embedding_model)
+        vector_bytes = model.get_sentence_embedding_dimension() * 4
+        memory_bytes = store.collection.count() * (vector_bytes + store.chunk_size)
+        disk_bytes = os.path.getsize(file_path) + memory_bytes
+        return SessionStore(store, file_path, memory_bytes, disk_bytes)
+
+    def remove(self, entry: SessionStore):
+        semantic_cache.discard(entry.store.collection.name)
+        try:
+            entry.store.delete()
+        except Exception as e:
+            pass
+        self.remove_file(entry.file_path)
+
+    def remove_orphans(self):
+        """Delete uploads and collections left behind by earlier runs, which no entry owns.
+
+        Files written since this process started are kept, as they may belong to another
+        worker sharing the directories, and so are their collections.
+        """
+        owned = {entry.file_path for entry in self._stores.values()}
+        live_keys = set()
+        if os.path.isdir(self.upload_dir):
+            for name in os.listdir(self.upload_dir):
+                file_path = os.path.join(self.upload_dir, name)
+                if file_path in owned or os.path.getmtime(file_path) >= self._started:
+                    live_keys.add(name.split(".", 1)[0])
+                else:
+                    self.remove_file(file_path)
+
+        if os.path.isdir(self.persist_store):
+            client = chromadb.PersistentClient(path=self.persist_store)
+            for collection in client.list_collections():
+                key = collection.name.removeprefix("profile-").split("-", 1)[0]
+                if collection.name.startswith("profile-") and key not in live_keys:
+                    client.delete_collection(collection.name)
+
+    @staticmethod
+    def remove_file(file_path):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,77 @@
+import asyncio
+
+
+class Flight:
+    """One upstream stream and the chunks it has produced so far."""
+
+    def __init__(self):
+        self.chunks: list = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        self.task: asyncio.Task | None = None
+
+        self._updated = asyncio.Event()
+
+    def notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def wait(self):
+        await self._updated.wait()
+
+
+class SingleFlight:
+    """Shares one upstream stream between all concurrent requests with the same key.
+
+    Every subscriber receives every chunk from the start, including subscribers that join
+    part way through. The upstream is cancelled if all of its subscribers go away.
+    """
+
+    def __init__(self):
+        self._flights: dict[str, Flight] = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def stream(self, key, start):
+        """Yield the chunks of start(), unless a stream for key is already running."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, start()))
+
+        flight.subscribers += 1
+        try:
+            position = 0
+            while True:
+                while position < len(flight.chunks):
+                    yield flight.chunks[position]
+                    position += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    async def _run(self, key, flight: Flight, upstream):
+        try:
+            async for chunk in upstream:
+                flight.chunks.append(chunk)
+                flight.notify()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            flight.notify()
+            self._forget(key, flight)
+
+    def _forget(self, key, flight):
+        # A newer flight may already be running for the key
+        if self._flights.get(key) is flight:
+            del self._flights[key]
@@ -0,0 +1,119 @@
+import asyncio
+import statistics
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# The watsonx SDKs are blocking, so completions are consumed on this pool and handed
+# back to the event loop chunk by chunk
+LLM_WORKERS = 16
+_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm")
+
+_done = object()
+
+
+class LatencyStats:
+    """Recent time-to-first-token and total durations of completions for one model."""
+
+    def __init__(self, window=200):
+        self.first_token = deque(maxlen=window)
+        self.total = deque(maxlen=window)
+
+    def record(self, first_token, total):
+        self.first_token.append(first_token)
+        self.total.append(total)
+
+    def summary(self) -> dict:
+        if not self.first_token:
+            return {"count": 0}
+        return {
+            "count": len(self.first_token),
+            "first_token_p50": statistics.median(self.first_token),
+            "first_token_last": self.first_token[-1],
+            "total_p50": statistics.median(self.total),
+        }
+
+
+latency_stats: dict[str, LatencyStats] = {}
+
+
+async def astream(llm, prompt, label="llm", stream=None):
+    """Yield chunks of llm.stream(prompt) as they arrive without blocking the event loop.
+
+    Works for both watsonx backends, and records time-to-first-token under label. Pass
+    stream to produce the chunks with another of the client's blocking stream methods.
+    """
+    stream = stream or llm.stream
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = False
+
+    def produce():
+        try:
+            for chunk in stream(prompt):
+                if cancelled:
+                    return
+                loop.call_soon_threadsafe(queue.put_nowait, chunk)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, _done)
+
+    start = time.perf_counter()
+    first_token = None
+    loop.run_in_executor(_executor, produce)
+    try:
+        while (chunk := await queue.get()) is not _done:
+            if isinstance(chunk, Exception):
+                raise chunk
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            yield chunk
+    finally:
+        # Stop the producer if the consumer went away part way through
+        cancelled = True
+
+    total = time.perf_counter() - start
+    latency_stats.setdefault(label, LatencyStats()).record(
+        first_token if first_token is not None else total, total
+    )
+
+
+async def athrottle(chunks, interval=0.05, max_chars=64):
+    """Coalesce an async stream of text into larger pieces for UI updates.
+
+    Buffered text is flushed once max_chars have arrived or interval seconds have passed
+    since the last flush, whichever comes first, even if the stream stalls.
+    """
+    chunks = aiter(chunks)
+    buffer = []
+    buffered_chars = 0
+    last_flush = time.monotonic()
+
+    next_chunk = asyncio.ensure_future(anext(chunks))
+    try:
+        while True:
+            timeout = max(0.0, last_flush + interval - time.monotonic()) if buffer else None
+            done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+            if done:
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                buffer.append(chunk)
+                buffered_chars += len(chunk)
+                next_chunk = asyncio.ensure_future(anext(chunks))
+
+            if buffer and (
+                buffered_chars >= max_chars or time.monotonic() - last_flush >= interval
+            ):
+                yield "".join(buffer)
+                buffer.clear()
+                buffered_chars = 0
+                last_flush = time.monotonic()
+    finally:
+        next_chunk.cancel()
+
+    if buffer:
+        yield "".join(buffer)
+
@@ -0,0 +1,122 @@
+import asyncio
+from typing import Any, Callable, NamedTuple
+
+_done = object()
+
+# Shared by every graph, so the limit holds across concurrent graphs (e.g. several uploads)
+_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+_limits: dict[str, int] = {}
+
+
+def backend_semaphore(backend, limit) -> asyncio.Semaphore:
+    """The process-wide semaphore for backend, created with limit on first use."""
+    semaphore = _semaphores.get(backend)
+    if semaphore is None:
+        semaphore = _semaphores[backend] = asyncio.Semaphore(limit)
+        _limits[backend] = limit
+    elif _limits[backend] != limit:
+        raise ValueError(
+            f"Backend {backend} is already limited to {_limits[backend]} steps, not {limit}"
+        )
+    return semaphore
+
+
+class Step(NamedTuple):
+    name: str
+    # Called with the results of the steps in after, returns a coroutine or an async iterator
+    fn: Callable
+    after: tuple[str, ...]
+    # Steps with the same backend share its concurrency limit
+    backend: str | None
+
+
+class _Failed(NamedTuple):
+    error: BaseException
+
+
+class TaskGraph:
+    """Runs async steps as soon as the steps they depend on have finished.
+
+    Independent steps run concurrently, up to limits[backend] at a time across all graphs
+    for steps on a limited backend. A step may return an async iterator of text, in which case its
+    items are streamed out of stream() as they arrive and its result is the joined text.
+    """
+
+    def __init__(self, limits: dict[str, int] | None = None):
+        self.steps: dict[str, Step] = {}
+        self.results: dict[str, Any] = {}
+        self._semaphores = {
+            backend: backend_semaphore(backend, limit)
+            for backend, limit in (limits or {}).items()
+        }
+
+    def add(self, name, fn, after=(), backend=None):
+        """Declare a step, after the steps whose results it takes as arguments."""
+        if name in self.steps:
+            raise ValueError(f"Step {name} is already declared")
+        for dependency in after:
+            if dependency not in self.steps:
+                raise ValueError(f"Step {name} depends on undeclared step {dependency}")
+        self.steps[name] = Step(name, fn, tuple(after), backend)
+        return self
+
+    async def stream(self):
+        """Run the graph, yielding (step name, item) for items of streaming steps."""
+        queue = asyncio.Queue()
+        tasks: dict[str, asyncio.Task] = {}
+
+        async def run_step(step: Step):
+            arguments = [await tasks[dependency] for dependency in step.after]
+            semaphore = self._semaphores.get(step.backend)
+            if semaphore is None:
+                result = await self.call(step, arguments, queue)
+            else:
+                async with semaphore:
+                    result = await self.call(step, arguments, queue)
+            self.results[step.name] = result
+            return result
+
+        async def run_all():
+            try:
+                await asyncio.gather(*tasks.values())
+            except Exception as e:
+                await queue.put((None, _Failed(e)))
+            else:
+                await queue.put((None, _done))
+
+        # Steps can only depend on steps declared before them, so this order is topological
+        for name, step in self.steps.items():
+            tasks[name] = asyncio.create_task(run_step(step))
+        runner = asyncio.create_task(run_all())
+
+        try:
+            while True:
+                name, item = await queue.get()
+                if item is _done:
+                    break
+                if isinstance(item, _Failed):
+                    raise item.error
+                yield name, item
+        finally:
+            for task in [*tasks.values(), runner]:
+                task.cancel()
+
+    async def run(self) -> dict[str, Any]:
+        """Run the graph to completion and return every step's result."""
+        async for _ in self.stream():
+            pass
+        return self.results
+
+    @staticmethod
+    async def call(step: Step, arguments, queue):
+        output = step.fn(*arguments)
+        if not hasattr(output, "__aiter__"):
+            return await output
+
+        items = []
+        async for item in output:
+            items.append(item)
+            await queue.put((step.name, item))
+        return "".join(items)
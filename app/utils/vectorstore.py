@@ -1,68 +1,323 @@
+import asyncio
 import chromadb
-import uuid
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pypdf import PdfReader
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
-from typing import Any 
+from itertools import islice
+from typing import Any, NamedTuple
+
+from app.utils.bm25 import BM25Index, reciprocal_rank_fusion
+from app.utils.lrucache import LRUCache
+from app.utils.embeddings import (
+    DEFAULT_EMBEDDING_MODEL,
+    get_embedding_model,
+    get_embedding_pool,
+)
+
+# Embedding and HNSW search are CPU bound, so they run on a dedicated pool rather than the
+# event loop. The pool size bounds how many of them run at once across all sessions.
+VECTORSTORE_WORKERS = 4
+_executor = ThreadPoolExecutor(max_workers=VECTORSTORE_WORKERS, thread_name_prefix="vectorstore")
+# Leave workers free for queries while large uploads are being ingested
+_ingest_slots = asyncio.Semaphore(max(1, VECTORSTORE_WORKERS // 2))
+
+
+async def run_in_vectorstore_executor(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+
+def chunk_id(chunk):
+    """Identify a chunk by its contents so re-ingesting it is a no-op."""
+    return hashlib.sha256(chunk.encode()).hexdigest()
+
+
+class PreviousIndex(NamedTuple):
+    name: str
+    complete: bool
+
+
+def mark_complete(collection, complete=True):
+    """Record whether the collection holds the whole file, so partial builds aren't reopened."""
+    # The distance function can't be changed after creation, so leave the hnsw settings out
+    metadata = {
+        key: value
+        for key, value in (collection.metadata or {}).items()
+        if not key.startswith("hnsw:")
+    }
+    collection.modify(metadata={**metadata, "complete": complete})
+
+
+def batched(iterable, size):
+    """Split an iterable into lists of at most size items without materialising it."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
 
 
 class VectorStore(BaseModel): 
     chunk_size: int = 1000
     chunk_overlap: int = 200 
-    embedding_model: str = 'sentence-transformers/all-MiniLM-L12-v2'
+    embedding_model: str = DEFAULT_EMBEDDING_MODEL
+    # Number of chunks held in memory and embedded together while ingesting
+    ingest_batch_size: int = 256
+    # Number of texts per forward pass of the embedding model
+    encode_batch_size: int = 32
+    # Worker processes used to embed while ingesting, 0 or 1 embeds in this process
+    ingest_workers: int = 0
+
+    # Number of chunks returned by query, and the number of dense and keyword candidates fused
+    n_results: int = 3
+    n_candidates: int = 10
+    rrf_k: int = 60
 
     collection_name: str = 'langchain'
     collection: Any 
+    keyword_index: Any = None
+    # Bumped on every change to the collection, invalidating cached query results
+    version: int = 0
+    query_cache_size: int = 256
+    query_cache: Any = None
+    # Question embeddings don't depend on the collection, so they outlive version changes
+    embedding_cache: Any = None
+    persist_store: str
 
     def __init__(self, file_path, persist_store="assets/whispervectorstore/", **kwargs) -> chromadb.Collection:
-        super().__init__(**kwargs)
+        super().__init__(persist_store=persist_store, **kwargs)
+        self.keyword_index = BM25Index()
+        self.query_cache = LRUCache(self.query_cache_size)
+        self.embedding_cache = LRUCache(self.query_cache_size)
 
         client = chromadb.PersistentClient(path=persist_store)
-        try: 
-            client.delete_collection(self.collection_name)
-        except Exception as e: 
-            pass   
-        collection = client.create_collection(name=self.collection_name, metadata={"hnsw:space": "cosine"})
+        index_name = self.index_name(file_path)
 
-        chunks = self.chunk_file(file_path, self.chunk_size, self.chunk_overlap)
-        embeddings = self.create_embeddings(chunks)
-        ids = [str(uuid.uuid1()) for x in range(len(chunks))]
-        collection.add(ids, embeddings.tolist(), documents=chunks)
+        # Reopen the persisted index if this exact file and configuration was already embedded
+        try:
+            collection = client.get_collection(index_name)
+        except Exception as e:
+            collection = None
 
-        self.collection = collection
+        # A build killed part way through is left incomplete, and finished on the next boot
+        if collection is None or not (collection.metadata or {}).get("complete"):
+            collection, previous = self.reuse_previous_index(client, index_name)
+            self.collection = collection
+            # What the reused build held, to put it back as it was if this build fails
+            if previous is not None:
+                previous_ids = set(collection.get(include=[])['ids'])
+            try:
+                chunk_ids = self.add_documents(
+                    self.chunk_file(file_path, self.chunk_size, self.chunk_overlap)
+                )
+                # Chunks of the previous version that are no longer in the file, documents
+                # added with add_file aren't part of the file and are kept
+                added = collection.get(where={"added": True}, include=["documents"])
+                stale_ids = set(collection.get(include=[])['ids']) - chunk_ids - set(added['ids'])
+                if stale_ids:
+                    collection.delete(ids=list(stale_ids))
+                    self.version += 1
+                for id, document in zip(added['ids'], added['documents']):
+                    self.keyword_index.add(id, document)
+                mark_complete(collection)
+            except Exception:
+                if previous is None:
+                    # Don't leave a half built index behind to be reopened on the next boot
+                    client.delete_collection(index_name)
+                else:
+                    # The earlier build may still be in use, e.g. by a session whose new
+                    # upload failed, so restore it rather than dropping it
+                    added_ids = set(collection.get(include=[])['ids']) - previous_ids
+                    if added_ids:
+                        collection.delete(ids=list(added_ids))
+                    collection.modify(name=previous.name)
+                    mark_complete(collection, previous.complete)
+                raise
+        else:
+            self.collection = collection
+            stored = collection.get(include=["documents"])
+            for id, document in zip(stored['ids'], stored['documents']):
+                self.keyword_index.add(id, document)
 
-    def chunk_file(self, file_path, chunk_size, chunk_overlap):
-        reader = PdfReader(file_path)
-        number_of_pages = len(reader.pages)
+    def index_name(self, file_path):
+        """Name the collection after the file contents and every setting that changes the index."""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file_object:
+            for block in iter(lambda: file_object.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(f"{self.chunk_size}:{self.chunk_overlap}:{self.embedding_model}".encode())
+        # Chunking scheme, bumped whenever chunk_file changes how it splits the text
+        digest.update(b"pages")
+
+        return f"{self.collection_name}-{digest.hexdigest()[:32]}"
+
+    def reuse_previous_index(self, client, index_name):
+        """Rename an earlier build of this collection to index_name so its unchanged chunks
+        don't need embedding again, dropping any other earlier builds.
+
+        Returns the collection, and the name and completeness of the earlier build if one
+        was renamed.
+        """
+        collection = None
+        renamed = None
+        for previous in client.list_collections():
+            if previous.name != self.collection_name and not previous.name.startswith(f"{self.collection_name}-"):
+                continue
+            if collection is None and (previous.metadata or {}).get("embedding_model") == self.embedding_model:
+                if previous.name != index_name:
+                    renamed = PreviousIndex(
+                        previous.name, bool((previous.metadata or {}).get("complete"))
+                    )
+                    previous.modify(name=index_name)
+                    mark_complete(previous, False)
+                collection = previous
+            else:
+                client.delete_collection(previous.name)
+
+        if collection is None:
+            collection = client.create_collection(
+                name=index_name,
+                metadata={
+                    "hnsw:space": "cosine",
+                    "embedding_model": self.embedding_model,
+                    "complete": False,
+                },
+            )
+        return collection, renamed
+
+    def add_documents(self, chunks, added=False) -> set[str]:
+        """Upsert chunks into the collection, only embedding the ones it doesn't hold yet.
 
-        texts = []
-        for pageno in range(number_of_pages): 
-            page = reader.pages[pageno]
-            texts.append(page.extract_text())
-        texts = ' '.join(texts)
+        Returns the ids of all the chunks, which are derived from their contents. Chunks
+        marked as added are kept when the collection is rebuilt from a new version of the file.
+        """
+        chunk_ids = set()
+        for batch in batched(chunks, self.ingest_batch_size):
+            new_chunks = {}
+            for chunk in batch:
+                id = chunk_id(chunk)
+                new_chunks.setdefault(id, chunk)
+                self.keyword_index.add(id, chunk)
+            chunk_ids.update(new_chunks)
 
-        chunk_size = 1000
-        chunk_overlap = 200
+            for existing_id in self.collection.get(ids=list(new_chunks), include=[])['ids']:
+                del new_chunks[existing_id]
+            if not new_chunks:
+                continue
 
-        chunks = [] 
-        while len(texts) > 0: 
-            if len(texts) < chunk_size: 
-                chunks.append(texts)
-                texts = ''
-            else: 
-                chunks.append(texts[0:1000])
-                texts = texts[chunk_size-chunk_overlap:]
+            # Similar lengths in each forward pass keeps padding to a minimum
+            ids = sorted(new_chunks, key=lambda id: len(new_chunks[id]))
+            documents = [new_chunks[id] for id in ids]
+            embeddings = self.embed_documents(documents)
+            self.collection.upsert(
+                ids,
+                embeddings.tolist(),
+                metadatas=[{"added": added}] * len(ids),
+                documents=documents,
+            )
+            self.version += 1
 
-        return chunks 
+        return chunk_ids
+
+    def add_file(self, file_path) -> set[str]:
+        """Add another document to the store without rebuilding what's already indexed."""
+        return self.add_documents(
+            self.chunk_file(file_path, self.chunk_size, self.chunk_overlap), added=True
+        )
+
+    def delete(self):
+        """Remove this store's collection from the persist directory."""
+        client = chromadb.PersistentClient(path=self.persist_store)
+        client.delete_collection(self.collection.name)
+
+    def chunk_file(self, file_path, chunk_size, chunk_overlap):
+        """Lazily yield overlapping chunks of the PDF text, one page in memory at a time.
+
+        Windows start again on every page, so editing a page only changes that page's
+        chunks and the rest don't need embedding again.
+        """
+        if not 0 <= chunk_overlap < chunk_size:
+            raise ValueError("chunk_overlap must be non-negative and smaller than chunk_size")
+        step = chunk_size - chunk_overlap
+
+        reader = PdfReader(file_path)
+        for page in reader.pages:
+            text = page.extract_text()
+            if not text.strip():
+                continue
+            # The last window ends at the end of the page
+            for start in range(0, max(len(text) - chunk_overlap, 1), step):
+                yield text[start:start + chunk_size]
 
     def create_embeddings(self, chunks): 
-        model = SentenceTransformer('thenlper/gte-small')
-        embeddings = model.encode(chunks)
+        model = get_embedding_model(self.embedding_model)
+        embeddings = model.encode(chunks, batch_size=self.encode_batch_size)
 
         return embeddings
 
-    def query(self, prompt): 
-        query_embedding = self.create_embeddings(prompt).tolist()
-        query_results = self.collection.query(query_embedding, n_results=3)
-        return '\n\n '.join(query_results['documents'][0])
+    def embed_documents(self, chunks):
+        """Embed a batch of chunks for ingestion, spread across worker processes if configured."""
+        if self.ingest_workers <= 1 or len(chunks) < 2 * self.encode_batch_size:
+            return self.create_embeddings(chunks)
+
+        model = get_embedding_model(self.embedding_model)
+        pool = get_embedding_pool(self.embedding_model, self.ingest_workers)
+        return model.encode_multi_process(chunks, pool, batch_size=self.encode_batch_size)
+
+    def query(self, prompt, query_embedding=None): 
+        """Return the best chunks for prompt, fusing dense and keyword search rankings.
+
+        Pass query_embedding if prompt has already been embedded with this store's model.
+        """
+        # Entries for older versions of the collection are never looked up again and age out
+        key = (' '.join(prompt.split()).casefold(), self.version)
+        cached = self.query_cache.get(key)
+        if cached is not None:
+            return cached
+
+        if query_embedding is None:
+            query_embedding = self.embed_query(prompt)
+        query_embedding = query_embedding.tolist()
+
+        query_results = self.collection.query(query_embedding, n_results=self.n_candidates)
+        documents = dict(zip(query_results['ids'][0], query_results['documents'][0]))
+
+        keyword_ids = [id for id, score in self.keyword_index.search(prompt, self.n_candidates)]
+        ids = reciprocal_rank_fusion([query_results['ids'][0], keyword_ids], k=self.rrf_k)[:self.n_results]
+
+        missing = [id for id in ids if id not in documents]
+        if missing:
+            keyword_results = self.collection.get(ids=missing, include=["documents"])
+            documents.update(zip(keyword_results['ids'], keyword_results['documents']))
+
+        results = '\n\n '.join(documents[id] for id in ids if id in documents)
+        self.query_cache.put(key, results)
+        return results
+
+    def embed_query(self, prompt):
+        """Embedding of prompt, reusing the one from an earlier query of the same text."""
+        embedding = self.embedding_cache.get(prompt)
+        if embedding is None:
+            embedding = self.create_embeddings(prompt)
+            self.embedding_cache.put(prompt, embedding)
+        return embedding
+
+    @property
+    def cache_stats(self) -> dict:
+        """Hit and miss counts of the query and embedding caches, for sizing query_cache_size."""
+        return {"queries": self.query_cache.stats, "embeddings": self.embedding_cache.stats}
+
+    async def aquery(self, prompt, query_embedding=None):
+        """Like query, but awaitable without blocking the event loop."""
+        return await run_in_vectorstore_executor(self.query, prompt, query_embedding)
+
+    @classmethod
+    async def aingest(cls, file_path, **kwargs):
+        """Build (or reopen) the store for file_path without blocking the event loop."""
+        async with _ingest_slots:
+            return await run_in_vectorstore_executor(cls, file_path, **kwargs)
 
+    async def aadd_file(self, file_path):
+        """Like add_file, but awaitable without blocking the event loop."""
+        async with _ingest_slots:
+            return await run_in_vectorstore_executor(self.add_file, file_path)
@@ -1,20 +1,44 @@
 # Import base deps
 import reflex as rx 
 from pydantic import BaseModel
+from typing import ClassVar
 # Import IBM Gen 
 from ibm_watson_machine_learning.foundation_models import Model
 from ibm_watson_machine_learning.metanames import GenTextParamsMetaNames as GenParams
 from ibm_watson_machine_learning.foundation_models.extensions.langchain import WatsonxLLM
 
+from app.utils.llmcache import CachedLLM
+from app.utils.llmregistry import SharedLLM
+
 # Get reflex config
 config = rx.config.get_config()
 
+
+class StreamingWatsonxLLM(WatsonxLLM):
+    """WatsonxLLM that streams tokens like the workbench interface does."""
+
+    def stream(self, prompt, *args, **kwargs):
+        # Older SDK releases can only return the whole completion
+        if not hasattr(self.model, "generate_text_stream"):
+            yield self(prompt)
+            return
+        yield from self.model.generate_text_stream(prompt=prompt)
+
+
 class WatsonxLangchainLLM(BaseModel): 
     
     generate_params: dict = { GenParams.MAX_NEW_TOKENS: 25 }
 
     model_id: str = "google/flan-ul2"
 
+    # Serve repeated greedy completions from the response cache
+    cache: bool = True
+
+    backend: ClassVar[str] = "ga"
+
+    def shared(self):
+        """Lazily get the process-wide client for this model and params."""
+        return SharedLLM(self)
 
     def from_pretrained(self):
 
@@ -28,5 +52,7 @@ class WatsonxLangchainLLM(BaseModel):
             project_id=config.watsonx_project_id
         )
 
-        llm = WatsonxLLM(model=model)
+        llm = StreamingWatsonxLLM(model=model)
+        if self.cache:
+            llm = CachedLLM(llm, self.model_id, self.generate_params)
         return llm 
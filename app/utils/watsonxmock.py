@@ -0,0 +1,95 @@
+# Import base deps
+import hashlib
+import random
+import time
+
+import reflex as rx
+from pydantic import BaseModel
+from typing import ClassVar
+
+from ibm_watson_machine_learning.metanames import GenTextParamsMetaNames as GenParams
+
+from app.utils.llmcache import CachedLLM
+from app.utils.llmregistry import SharedLLM
+
+# Get reflex config
+config = rx.config.get_config()
+
+VOCABULARY = (
+    "watsonx client model data answer question business value platform governance "
+    "insight customer solution deploy prompt token foundation workflow cloud team "
+    "strategy risk growth analysis the a of and to in for with on is can will"
+).split()
+
+
+class MockWatsonxError(Exception):
+    """Simulated failure of a watsonx request."""
+
+
+class MockLLM:
+    """Offline stand-in for the watsonx langchain clients.
+
+    The completion is a function of the model id and prompt only, and is produced at a
+    configurable time-to-first-token and tokens per second, failing at error_rate.
+    """
+
+    def __init__(
+        self,
+        model_id,
+        max_new_tokens=25,
+        time_to_first_token=0.3,
+        tokens_per_second=20.0,
+        error_rate=0.0,
+    ):
+        self.model_id = model_id
+        self.max_new_tokens = max_new_tokens
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+
+    def tokens(self, prompt):
+        seed = hashlib.sha256(f"{self.model_id}\n{prompt}".encode()).digest()
+        generator = random.Random(seed)
+        return [f"{generator.choice(VOCABULARY)} " for _ in range(self.max_new_tokens)]
+
+    def stream(self, prompt, *args, **kwargs):
+        if random.random() < self.error_rate:
+            time.sleep(self.time_to_first_token)
+            raise MockWatsonxError(f"Simulated failure from {self.model_id}")
+
+        time.sleep(self.time_to_first_token)
+        for index, token in enumerate(self.tokens(prompt)):
+            if index and self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            yield token
+
+    def __call__(self, prompt) -> str:
+        return "".join(self.stream(prompt))
+
+
+class WatsonxMockLangchainLLM(BaseModel):
+    generate_params: dict = {GenParams.MAX_NEW_TOKENS: 25}
+
+    model_id: str = "google/flan-ul2"
+
+    # Serve repeated greedy completions from the response cache
+    cache: bool = True
+
+    backend: ClassVar[str] = "mock"
+
+    def shared(self):
+        """Lazily get the process-wide client for this model and params."""
+        return SharedLLM(self)
+
+    def from_pretrained(self):
+        llm = MockLLM(
+            self.model_id,
+            max_new_tokens=self.generate_params.get(GenParams.MAX_NEW_TOKENS, 25),
+            time_to_first_token=config.watsonx_mock_time_to_first_token,
+            tokens_per_second=config.watsonx_mock_tokens_per_second,
+            error_rate=config.watsonx_mock_error_rate,
+        )
+        if self.cache:
+            llm = CachedLLM(llm, self.model_id, self.generate_params)
+
+        return llm
@@ -1,6 +1,7 @@
 # Import base deps
 import reflex as rx
 from pydantic import BaseModel
+from typing import ClassVar
 
 # Import IBM Gen
 from genai.model import Credentials
@@ -8,6 +9,9 @@ from genai.model import Credentials
 from ibm_watson_machine_learning.metanames import GenTextParamsMetaNames as GenParams
 from genai.extensions.langchain import LangChainInterface
 
+from app.utils.llmcache import CachedLLM
+from app.utils.llmregistry import SharedLLM
+
 
 # Get reflex config
 config = rx.config.get_config()
@@ -18,6 +22,15 @@ class WatsonxWorkbenchLangchainLLM(BaseModel):
 
     model_id: str = "google/flan-ul2"
 
+    # Serve repeated greedy completions from the response cache
+    cache: bool = True
+
+    backend: ClassVar[str] = "workbench"
+
+    def shared(self):
+        """Lazily get the process-wide client for this model and params."""
+        return SharedLLM(self)
+
     def from_pretrained(self):
         creds = Credentials(
             config.watsonx_workbench_api_key,
@@ -29,5 +42,7 @@ class WatsonxWorkbenchLangchainLLM(BaseModel):
             credentials=creds,
             params=self.generate_params,
         )
+        if self.cache:
+            llm = CachedLLM(llm, self.model_id, self.generate_params)
 
         return llm
@@ -0,0 +1,61 @@
+"""Compare VectorStore.query latency with and without the embedding model registry.
+
+Run from the repository root:
+
+    python -m benchmarks.vectorstore_query
+"""
+import statistics
+import time
+
+from sentence_transformers import SentenceTransformer
+
+from app.utils.vectorstore import VectorStore
+
+QUESTION = "Well, what is watsonx.ai?"
+RUNS = 10
+
+
+def time_queries(query, runs=RUNS):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        query(QUESTION)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def reload_per_query(store):
+    """Reproduces the old behaviour of loading the model on every query."""
+
+    def query(prompt):
+        model = SentenceTransformer(store.embedding_model)
+        query_embedding = model.encode(prompt).tolist()
+        query_results = store.collection.query(query_embedding, n_results=3)
+        return "\n\n ".join(query_results["documents"][0])
+
+    return query
+
+
+def uncached(store):
+    """store.query with its caches cleared, so every run embeds and searches."""
+
+    def query(prompt):
+        store.query_cache.clear()
+        store.embedding_cache.clear()
+        return store.query(prompt)
+
+    return query
+
+
+def report(name, timings):
+    print(
+        f"{name:<20} median {statistics.median(timings):8.1f} ms"
+        f"   max {max(timings):8.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    store = VectorStore("assets/ibmfaqs.pdf")
+
+    report("reload per query", time_queries(reload_per_query(store)))
+    report("shared registry", time_queries(uncached(store)))
@@ -0,0 +1,92 @@
+"""Compare the cost of sending each new WhisperBot message to the shared sessions.
+
+The old fan-out handed every other session the whole conversation, one session after
+another. The message log hands each session only the entries it hasn't seen, to all
+sessions at once. modify_state is simulated with a fixed round trip per session.
+
+Run from the repository root:
+
+    python -m benchmarks.whisper_fanout
+"""
+import asyncio
+import contextlib
+import time
+
+from app.utils.messagelog import MessageLog, fan_out
+
+SESSIONS = 8
+ROUND_TRIP = 0.002
+CONVERSATION_LENGTHS = (10, 100, 1000, 5000)
+MESSAGES = 20
+
+
+class Session:
+    def __init__(self):
+        self.messages = []
+        self._message_seq = 0
+        self._message_epoch = 0
+        self.substates = {"whisper_state": self}
+        self.received = 0
+
+    def _add_messages(self, messages, replace=False):
+        if replace:
+            self.messages = []
+        self.messages.extend(messages)
+
+
+sessions = {f"token-{index}": Session() for index in range(SESSIONS)}
+
+
+@contextlib.asynccontextmanager
+async def modify_state(token):
+    await asyncio.sleep(ROUND_TRIP)
+    yield sessions[token]
+
+
+async def copy_all(messages, tokens):
+    """Reproduces the old behaviour of copying the whole conversation to each session."""
+    for token in tokens:
+        async with modify_state(token) as state:
+            state.messages = list(messages)
+            state.received += len(messages)
+
+
+async def run(length, delta):
+    for session in sessions.values():
+        session.__init__()
+    log = MessageLog()
+    log.reset({"role": "client", "message": f"message {index}"} for index in range(length))
+    tokens = list(sessions)
+    if delta:
+        await fan_out(log, tokens, modify_state)
+    else:
+        await copy_all(log.entries, tokens)
+    for session in sessions.values():
+        session.received = 0
+
+    start = time.perf_counter()
+    for index in range(MESSAGES):
+        log.append("bot", f"reply {index}")
+        if delta:
+            before = {token: len(sessions[token].messages) for token in tokens}
+            await fan_out(log, tokens, modify_state)
+            for token in tokens:
+                sessions[token].received += len(sessions[token].messages) - before[token]
+        else:
+            await copy_all(log.entries, tokens)
+    elapsed = (time.perf_counter() - start) * 1000 / MESSAGES
+    received = sum(session.received for session in sessions.values()) / MESSAGES
+    return elapsed, received
+
+
+def report(name, length, elapsed, received):
+    print(
+        f"{name:<12} {length:>6} messages   {elapsed:8.2f} ms per message"
+        f"   {received:8.0f} entries sent per message"
+    )
+
+
+if __name__ == "__main__":
+    for length in CONVERSATION_LENGTHS:
+        report("copy all", length, *asyncio.run(run(length, delta=False)))
+        report("message log", length, *asyncio.run(run(length, delta=True)))
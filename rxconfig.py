@@ -9,7 +9,7 @@ class ReflexappConfig(rx.Config):
     """Additional configuration parameters"""
 
     # Specify GA or workbench/BAM - TBD
-    watsonx_type: str = os.getenv("watsonx_type")  # ga or workbench
+    watsonx_type: str = os.getenv("watsonx_type")  # ga, workbench or mock
 
     # IAM API key for GA, Standard APIkey for workbench
     watsonx_api_key: str = os.getenv("watsonx_api_key")
@@ -27,6 +27,39 @@ class ReflexappConfig(rx.Config):
     ### Depends if using GA or Workbench
     watsonx_workbench_api_endpoint: str = os.getenv("watsonx_workbench_api_endpoint")
 
+    # Offline mock backend (watsonx_type = "mock"): seconds before the first token, tokens
+    # streamed per second and the fraction of requests that fail
+    watsonx_mock_time_to_first_token: float = float(
+        os.getenv("watsonx_mock_time_to_first_token", 0.3)
+    )
+    watsonx_mock_tokens_per_second: float = float(
+        os.getenv("watsonx_mock_tokens_per_second", 20)
+    )
+    watsonx_mock_error_rate: float = float(os.getenv("watsonx_mock_error_rate", 0))
+
+    # Worker processes used to embed documents while ingesting, 0 embeds in the app process
+    embedding_workers: int = int(os.getenv("embedding_workers", 0))
+
+    # Cosine similarity above which a question is answered from the semantic answer cache
+    semantic_cache_threshold: float = float(os.getenv("semantic_cache_threshold", 0.95))
+
+    # Per backend limits on requests to watsonx: sustained rate, burst size, requests running
+    # at once and requests allowed to wait before new ones are turned away
+    llm_requests_per_second: float = float(os.getenv("llm_requests_per_second", 2))
+    llm_burst: int = int(os.getenv("llm_burst", 4))
+    llm_max_in_flight: int = int(os.getenv("llm_max_in_flight", 8))
+    llm_max_queue: int = int(os.getenv("llm_max_queue", 64))
+
+    # Where WhisperBot sessions and conversations are shared: empty keeps them in this
+    # process, redis://host:port shares them between workers, fakeredis:// is an embedded
+    # stand-in for trying that out locally
+    session_registry_url: str = os.getenv("session_registry_url", "")
+
+    # Seconds a WhisperBot conversation is kept once its last session has gone, and how
+    # often idle conversations are looked for
+    session_idle_ttl: int = int(os.getenv("session_idle_ttl", 3600))
+    session_sweep_interval: int = int(os.getenv("session_sweep_interval", 60))
+
 
 config = ReflexappConfig(
     app_name="app",